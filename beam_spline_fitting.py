@@ -7,7 +7,8 @@ __version__ = "0.2"
 
 """
 This program will read Apertif FITS files containing one beam map and fit them with RectBivariateSpline. 
-The resulting spline fits are written into a .csv file.
+The resulting spline fits are written into a .csv file, and their knots and coefficients into one .npz file
+that modules.spline_models.SplineModels evaluates on any grid.
 
 input: 
 - A date that has beam fits files in the base directory /tank/apertif/driftscans/
@@ -19,14 +20,12 @@ Example: python beam_spline_fitting.py -d '190303' -c 'Cas A'
 
 from glob import glob
 import os
-from scipy.interpolate import RectBivariateSpline
-from astropy.io import fits
-import matplotlib.pyplot as plt
-import numpy as np
-from numpy import arange
-import pandas as pd
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+from modules.fits_io import dtypes
+from modules.spline_models import (CutoutCache, SplineModelWriter, beam_number, fit_spline, spline_model,
+                                   spline_models_path, write_model_fits, write_spline_csv)
+
 
 def parse_args():
 
@@ -44,6 +43,12 @@ def parse_args():
                         help="Number of frequency bins. \n(default: '%(default)s').")   
     parser.add_argument('-d', '--date', default="test",
                         help="Output name. \n(default: '%(default)s').")                     
+    parser.add_argument('-m', '--fits_models', action='store_true',
+                        help="Also write the FITS models of make_beam_model.py from the same fits, for all channels.")
+    parser.add_argument('--dtype', default='float64', choices=sorted(dtypes),
+                        help="Data type of the FITS models. \n(default: '%(default)s').")
+    parser.add_argument('--compress', action='store_true',
+                        help="Write lossless tile compressed FITS models.")
                         
 
     args = parser.parse_args()
@@ -58,47 +63,45 @@ def main():
     calib = args.calibname
     
     if not os.path.exists(basedir + 'spline/{}/'.format(date)):
-		os.mkdir(basedir + 'spline/{}/'.format(date))
-    	    
+        os.mkdir(basedir + 'spline/{}/'.format(date))
+
+    # Every cube is read once, the cutouts of all channels are taken from the same read
+    cache = CutoutCache(px_width=20)
+    writer = None
+
     for pol in ['I', 'xx', 'yy']:
-		files=glob('{}/fits_files/{}/{}_{}_*{}.fits'.format(basedir, date, calib.replace(' ',''), date, pol)) 
-		files.sort()
-
-		hdu=fits.open(files[0])
-		beam=hdu[0].data
-		f0=hdu[0].header['CRVAL3']
-		fdelt=hdu[0].header['CDELT3']
-		hdu.close()
-		px_width = 20
-
-		#for chan in range(1,10):
-		for chan in range(1,18):
-			freq = f0 + fdelt * chan
-			bmap, fbeam, model = [], [], []
-
-			for i,t in enumerate(files):
-				hdu=fits.open(t)
-				beam=hdu[0].data
-				beam = np.nan_to_num(beam)
-				hdu.close()
-				bmap.append(np.flipud(beam[chan,int(hdu[0].header['CRPIX2'])-px_width:int(hdu[0].header['CRPIX2'])+px_width,
-							 int(hdu[0].header['CRPIX1'])-px_width:int(hdu[0].header['CRPIX1'])+px_width]))
-				x=arange(0,bmap[i].shape[1])
-				y=arange(0,bmap[i].shape[0])
-				fbeam.append(RectBivariateSpline(y,x,bmap[i]))  # spline interpolation
-				model.append(fbeam[i](y,x)) # 40x40 pixel model
-
-
-			df = pd.DataFrame()
-			maxlen = len(model[0].flatten())
-			for b,m in enumerate(model):
-				col = list(m.flatten())
-				if maxlen != len(col):
-					col.extend(['']*(maxlen-len(col)))
-				df['B{:02}_{}'.format(b,int(freq))] = col   #the column name is the beam number and the frequency
-			
-			
-			df.to_csv('{}/spline/{}/beam_models_{}_chann_{}_pol_{}.csv'.format(basedir, date, date, chan, pol))
+        files=glob('{}/fits_files/{}/{}_{}_*{}.fits'.format(basedir, date, calib.replace(' ',''), date, pol)) 
+        files.sort()
+
+        header = cache.header(files[0])
+        f0=header['CRVAL3']
+        fdelt=header['CDELT3']
+        if writer is None:
+            writer = SplineModelWriter(cache.px_width, (header['CDELT1'], header['CDELT2']))
+
+        #for chan in range(1,10):
+        for chan in range(1,18):
+            freq = f0 + fdelt * chan
+            splines = [fit_spline(cache.cutouts(t)[chan]) for t in files]
+            model = [spline_model(cache.cutouts(t)[chan], spline) for t, spline in zip(files, splines)]  # 40x40 pixel models
+            for t, spline in zip(files, splines):
+                writer.add(pol, beam_number(t), chan, freq, spline)
+
+            write_spline_csv('{}/spline/{}/beam_models_{}_chann_{}_pol_{}.csv'.format(basedir, date, date, chan, pol),
+                             model, freq)
+
+            if args.fits_models:
+                for i, t in enumerate(files):
+                    write_model_fits(basedir + 'fits_files/{}/beam_models/chann_{}/{}_{:02}_{}_model.fits'.format(
+                                     date, chan, date, i, pol), model[i], cache.header(t), freq,
+                                     px_width=cache.px_width, dtype=args.dtype, compress=args.compress)
+
+        # The cutouts of this polarisation are not needed anymore
+        cache.clear()
+
+    # The knots and coefficients of all fits, to evaluate the models on any grid (see modules/spline_models.py)
+    writer.write(spline_models_path(basedir, date))
+    print("Spline models written to {}".format(spline_models_path(basedir, date)))
 
 
 if __name__ == '__main__':
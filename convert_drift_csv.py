@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+This script converts the _exported_data_frequency_split.csv and _hadec.csv files of previously
+extracted drift scans into the binary store that is written by prepare_drift_data.py.
+The scan2fits scripts use the store when it exists, which is much faster to read.
+
+input:
+- A file with the list of task_ids
+
+Example: python convert_drift_csv.py -f task_id_lists/task_ids_190821.txt
+
+"""
+
+__author__ = "Helga Denes"
+__date__ = "$29-aug-2019 16:00:00$"
+__version__ = "0.1"
+
+import os
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+from modules import drift_store
+
+
+def parse_args():
+
+    parser = ArgumentParser(
+        description="Convert extracted drift scan csv files into binary stores",
+        formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('-f', '--task_ids', default='',
+                        help="File with task_ids. (default: '%(default)s').")
+    parser.add_argument('-o', '--basedir', default='/tank/apertif/driftscans/',
+                        help="Specify the root directory. \n(default: '%(default)s').")
+    parser.add_argument('-r', '--remove', action='store_true',
+                        help="Remove the csv data file after a successful conversion.")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    args = parse_args()
+    basedir = args.basedir
+
+    with open(args.task_ids) as f:
+        task_id = f.read().splitlines()
+
+    for tid in task_id:
+        data_file = '{}{}/{}_exported_data_frequency_split.csv'.format(basedir, tid, tid)
+        hadec_file = '{}{}/{}_hadec.csv'.format(basedir, tid, tid)
+        if not os.path.exists(data_file):
+            print("Could not find {}".format(data_file))
+            continue
+
+        print("Converting {}".format(tid))
+        drift_store.csv_to_store(data_file, hadec_file, drift_store.store_path(basedir, tid), task_id=tid)
+
+        if args.remove:
+            os.remove(data_file)
+
+
+if __name__ == '__main__':
+    main()
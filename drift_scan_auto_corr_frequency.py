@@ -8,87 +8,311 @@ __date__ = "$19-march-2020 16:00:00$"
 __version__ = "0.3"
 
 import casacore.tables as pt
+from functools import partial
 import matplotlib.pyplot as plt
+from multiprocessing import Pool
 import numpy as np
 import os
 import pandas as pd
 
+from modules import drift_store
+from modules.extraction_manifest import ExtractionManifest, manifest_path
 
-def extract_data(antennas, beams, chan_range, chan_bins, exclude, data_location, task_id):
+
+pols = ['xx', 'xy', 'yx', 'yy']    # the order of the correlations in the DATA column
+
+
+def bin_channels(amp, chan_bins):
 	"""
-	Extract drift scan data from MS files and put them into a pandas data frame. 
-	Data is extracted for each beam in 10 frequency bins and 4 different polarisations. 
-	Data is extracted averaged for all antennas and per antenna.
-	Several parameters can be specified:
+	Average the channels of the auto correlation amplitudes into frequency bins.
+	All bins are folded in one vectorised step from the cumulative sum over the channels,
+	which also works for the overlapping bins produced by data_to_csv.
+	Bins are clipped to the available channels like a python slice, empty bins are NaN.
+
+	amp: array of amplitudes with shape (rows, channels, polarisations)
+	chan_bins: A list of channel ranges relative to the first extracted channel. [[x1,x2],[x1,x2],...]
+	returns: array with shape (rows, bins, polarisations)
+	"""
+	edges = np.clip(np.asarray(chan_bins, dtype=int), 0, amp.shape[1])
+	cumsum = np.zeros((amp.shape[0], amp.shape[1] + 1, amp.shape[2]))
+	np.cumsum(amp, axis=1, out=cumsum[:, 1:, :])
+	width = (edges[:, 1] - edges[:, 0])[np.newaxis, :, np.newaxis]
+	with np.errstate(invalid='ignore', divide='ignore'):
+		binned = (cumsum[:, edges[:, 1], :] - cumsum[:, edges[:, 0], :]) / width
+
+	return binned
+
+
+def pol_slice(selected):
+	"""
+	The slice of the correlation axis of the DATA column to read for a selection of polarisations.
+	Evenly spaced polarisations (e.g. xx & yy) are read with a stride, so only they are read.
+
+	selected: list of polarisation names, in the order of pols
+	returns: first, last and step of the slice, and the indices of the selection in what is read (None for all)
+	"""
+	index = [pols.index(pol) for pol in selected]
+	if len(index) == 0 or index != sorted(set(index)):
+		raise ValueError('Polarisations {} are not a selection of {} in that order'.format(selected, pols))
+	step = index[1] - index[0] if len(index) > 1 else 1
+	if np.all(np.diff(index) == step):
+		return index[0], index[-1], step, None
+	return index[0], index[-1], 1, [i - index[0] for i in index]
+
+
+def read_auto_corr(ms_name, chan_range, chan_bins, exclude, chunk_rows=120, read_pols=pols, per_antenna=True):
+	"""
+	Read the auto correlations of one beam MS in a single pass over the table and split them
+	by antenna and time in numpy. The compound beam is the average of the included antennas
+	at each time step, the same as the gmeans over a GROUP BY TIME query.
+	The DATA column is read in chunks of rows and reduced to frequency bins straight away,
+	so the memory use is set by chunk_rows and not by the length of the observation.
+
+	ms_name: path of the MS file as a string
+	chan_range: rfi free channel range. A list with 2 numbers [x1,x2]
+	chan_bins: A list of channel ranges relative to chan_range[0]. [[x1,x2],[x1,x2],...]
+	exclude: a string with instructions for taql to exclude data from the compound beam, e.g. 'AND ANTENNA1!=11'
+	chunk_rows: number of rows to read from the MS at once (12 rows per time step for Apertif)
+	read_pols: the polarisations to read, in the order of pols
+	per_antenna: also keep the data per antenna. Without, only the rows of the compound beam are read.
+	returns: times (time), antenna ids (ant), per antenna data (ant, time, bin, pol),
+	         compound beam data (time, bin, pol). Without per_antenna there are no antenna ids.
+	"""
+	if per_antenna:
+		t = pt.taql('select from {} where ANTENNA1==ANTENNA2'.format(ms_name))
+	else:
+		t = pt.taql('select from {} where ANTENNA1==ANTENNA2 {}'.format(ms_name, exclude))
+	t_meta = pt.taql('select TIME, ANTENNA1, (TRUE {}) as INCLUDE from $1'.format(exclude), tables=[t])
+	times, time_idx = np.unique(t_meta.getcol('TIME'), return_inverse=True)
+	ant_ids, ant_idx = np.unique(t_meta.getcol('ANTENNA1'), return_inverse=True)
+	include = np.asarray(t_meta.getcol('INCLUDE'), dtype=bool)
+	t_meta.close()
+	if not per_antenna:
+		ant_ids = ant_ids[:0]
+
+	first, last, step, take = pol_slice(read_pols)
+	auto_corr_ant = np.full((len(ant_ids), len(times), len(chan_bins), len(read_pols)), np.nan)
+	sums = np.zeros((len(times), len(chan_bins), len(read_pols)))
+
+	for row in range(0, t.nrows(), chunk_rows):
+		nrow = min(chunk_rows, t.nrows() - row)
+		data = t.getcolslice('DATA', [chan_range[0], first], [chan_range[1] - 1, last], inc=[1, step], startrow=row,
+							 nrow=nrow)
+		if take is not None:
+			data = data[:, :, take]
+		binned = bin_channels(np.abs(data), chan_bins)
+		rows = slice(row, row + nrow)
+		if per_antenna:
+			auto_corr_ant[ant_idx[rows], time_idx[rows]] = binned
+		np.add.at(sums, time_idx[rows][include[rows]], binned[include[rows]])
+	t.close()
+
+	counts = np.bincount(time_idx[include], minlength=len(times))
+	with np.errstate(invalid='ignore', divide='ignore'):
+		auto_corr = sums / counts[:, np.newaxis, np.newaxis]
+
+	return times, ant_ids, auto_corr_ant, auto_corr
+
+
+def ms_name(data_location, task_id, beam):
+	return '{0}{1}/WSRTA{1}_B0{2:02}.MS'.format(data_location, task_id, beam)
+
+
+def extract_beam(beam, chan_range, chan_bins, exclude, data_location, task_id, chunk_rows=120, read_pols=pols,
+				 per_antenna=True):
+	"""
+	Read the auto correlations of one beam of a task with read_auto_corr.
+	Every beam is a separate MS, so this is the unit of work for the parallel extraction.
+
+	beam: beam number (integer)
+	returns: the output of read_auto_corr
+	"""
+	return read_auto_corr(ms_name(data_location, task_id, beam), chan_range, chan_bins, exclude, chunk_rows=chunk_rows,
+						  read_pols=read_pols, per_antenna=per_antenna)
+
+
+def extract_cube(antennas, beams, chan_range, chan_bins, exclude, data_location, task_id, chunk_rows=120, workers=1,
+				 manifest=None, read_pols=pols):
+	"""
+	Extract drift scan data from MS files into one dense float32 array with the layout of the
+	binary store (modules/drift_store.py): (beam, antenna, freq bin, pol, time).
+	Antenna slot 0 is the average of all antennas, slot n + 1 is antennas[n].
+	Antennas that are not in an MS are NaN. Each MS is read only once, see read_auto_corr.
 
 	antennas: A list with all the antennas to read out. (Apertif has 12) [0, 1, 2, 3, ...]
-	bemas: A list with all the beams to read out. (Apertif has 40) [0, 1, 2, 3, ...]
+			  An empty list for the compound beams only.
+	beams: A list with all the beams to read out. (Apertif has 40) [0, 1, 2, 3, ...]
 	chan_range: rfi free channel range. A list with 2 numbers [x1,x2] 
-	chan_bins: A list of channel ranges to bin the data in frequency. By default this function only uses channels between 14000 and 24500 because of strong RFI. [[x1,x2],[x1,x2],...]
+	chan_bins: A list of channel ranges to bin the data in frequency. [[x1,x2],[x1,x2],...]
 	exclude: a string with instructions for taql to exclude certain data, e.g. baselines or antennas.
 	data_location: location to copy the data to as a string e.g. '/tank/apertif/driftscans'
 	task_id: or observation id as a string 
+	chunk_rows: number of MS rows to read at once, this sets the memory use of the extraction
+	workers: number of processes that read beams in parallel. The results are always merged in the order of beams.
+	manifest: an ExtractionManifest (modules/extraction_manifest.py). Beams that the manifest has
+			  already extracted from the same MS are not read again, new beams are added to it.
+	read_pols: the polarisations to extract, in the order of pols, e.g. ['xx', 'yy'] for the beam maps
+	returns: times (time), data (beam, 1 + antenna, freq bin, pol, time)
+	"""
+	todo = [j for j in beams if manifest is None or not manifest.beam_done(j, ms_name(data_location, task_id, j))]
+
+	extract = partial(extract_beam, chan_range=chan_range, chan_bins=chan_bins, exclude=exclude,
+					  data_location=data_location, task_id=task_id, chunk_rows=chunk_rows, read_pols=read_pols,
+					  per_antenna=len(antennas) > 0)
+	if workers > 1 and len(todo) > 1:
+		pool = Pool(min(workers, len(todo)))
+		results = pool.imap(extract, todo)
+	else:
+		pool = None
+		results = map(extract, todo)
+
+	try:
+		for b, j in enumerate(beams):
+			if j in todo:
+				print('BEAM: {}'.format(j))
+				result = next(results)
+				if manifest is not None:
+					manifest.save_beam(j, ms_name(data_location, task_id, j), result)
+			else:
+				print('BEAM: {} already extracted'.format(j))
+				result = manifest.load_beam(j)
+			times, ant_ids, auto_corr_ant, auto_corr = result
+
+			if b == 0:
+				time_steps = len(times)
+				print('time steps in first beam: ', time_steps)
+				time_axis = times[:time_steps-3]
+				cube = np.full((len(beams), len(antennas) + 1, len(chan_bins), len(read_pols), len(time_axis)), np.nan,
+							   dtype=np.float32)
+			cube[b, 0] = np.transpose(auto_corr[:time_steps-3], (1, 2, 0))
+
+			for n, i in enumerate(antennas):
+				if i not in ant_ids:
+					print('ANT: {} not found'.format(i))
+					continue
+				a = list(ant_ids).index(i)
+				cube[b, n + 1] = np.transpose(auto_corr_ant[a, :time_steps-3], (1, 2, 0))
+	finally:
+		# all results have been merged (or extraction failed) when we get here
+		if pool is not None:
+			pool.terminate()
+
+	return time_axis, cube
+
+
+def cube_to_dataframe(times, cube, antennas, beams, read_pols=pols):
+	"""
+	Convert the output of extract_cube into a pandas data frame with one column per series,
+	as it is written to the _exported_data_frequency_split.csv files.
+	Antennas without data are left out.
+	"""
+	columns = {'time': times}
+	for b, j in enumerate(beams):
+		for k in range(cube.shape[2]):
+			for p, pol in enumerate(read_pols):
+				columns['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_' + pol] = cube[b, 0, k, p]
+
+		for n, i in enumerate(antennas):
+			if np.all(np.isnan(cube[b, n + 1])):
+				continue
+			for k in range(cube.shape[2]):
+				for p, pol in enumerate(read_pols):
+					columns['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_' + pol + '_antenna_' + str(i)] = cube[b, n + 1, k, p]
+
+	return pd.DataFrame(columns)
+
+
+def extract_data(antennas, beams, chan_range, chan_bins, exclude, data_location, task_id, chunk_rows=120, workers=1,
+				 read_pols=pols):
+	"""
+	Extract drift scan data from MS files and put them into a pandas data frame. 
+	Data is extracted for each beam in 10 frequency bins and the polarisations in read_pols (all 4 by default).
+	Data is extracted averaged for all antennas and per antenna (only averaged for an empty list of antennas).
+	The parameters are the same as for extract_cube.
 	""" 
-	chan_range_1 = str(chan_range[0])
-	chan_range_2 = str(chan_range[1])
+	times, cube = extract_cube(antennas, beams, chan_range, chan_bins, exclude, data_location, task_id,
+							   chunk_rows=chunk_rows, workers=workers, read_pols=read_pols)
 
-	df = pd.DataFrame()
+	return cube_to_dataframe(times, cube, antennas, beams, read_pols=read_pols)
 
-	for j in beams:
-		t = pt.taql(
-			'select TIME, gmeans(abs(DATA[{0}:{1},0])) as XXPOL, gmeans(abs(DATA[{0}:{1},1])) as XYPOL, gmeans(abs(DATA[{0}:{1},2])) as YXPOL, gmeans(abs(DATA[{0}:{1},3])) as YYPOL from {2}{3}/WSRTA{3}_B0{4:02}.MS where ANTENNA1==ANTENNA2 {5} GROUP BY TIME'.format(chan_range[0], chan_range[1], data_location, task_id, j, exclude))
-		print('BEAM: {}'.format(j))
-		times = np.array(pt.tablecolumn(t, 'TIME'))
-		if j==beams[0]:
-			time_steps = len(times)
-			print('time steps in first beam: ', time_steps)
-		df['time'] = times[:time_steps-3]
-		for k, chan in enumerate(chan_bins):
-			data_beam_xx = np.mean(np.array(pt.tablecolumn(t, 'XXPOL'))[:, chan[0]:chan[1], :], axis=1)
-			auto_corr_xx = np.reshape(data_beam_xx, len(data_beam_xx))
-			data_beam_xy = np.mean(np.array(pt.tablecolumn(t, 'XYPOL'))[:, chan[0]:chan[1], :], axis=1)
-			auto_corr_xy = np.reshape(data_beam_xy, len(data_beam_xy))
-			data_beam_yx = np.mean(np.array(pt.tablecolumn(t, 'YXPOL'))[:, chan[0]:chan[1], :], axis=1)
-			auto_corr_yx = np.reshape(data_beam_yx, len(data_beam_yx))						
-			data_beam_yy = np.mean(np.array(pt.tablecolumn(t, 'YYPOL'))[:, chan[0]:chan[1], :], axis=1)
-			auto_corr_yy = np.reshape(data_beam_yy, len(data_beam_yy))
-			df['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_xx'] = auto_corr_xx[:time_steps-3]
-			df['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_xy'] = auto_corr_xy[:time_steps-3]
-			df['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_yx'] = auto_corr_yx[:time_steps-3]
-			df['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_yy'] = auto_corr_yy[:time_steps-3]
-
-		for i in antennas:
-			t_ant = pt.taql(
-				'select TIME, abs(DATA[{0}:{1},0]) as XXPOL, abs(DATA[{0}:{1},1]) as XYPOL, abs(DATA[{0}:{1},2]) as YXPOL, abs(DATA[{0}:{1},3]) as YYPOL from {2}{3}/WSRTA{3}_B0{4:02}.MS where ANTENNA1==ANTENNA2 AND ANTENNA1={5} GROUP BY TIME'.format(chan_range[0], chan_range[1], data_location, task_id, j, i))
-			print('ANT: {}'.format(i))
-
-			for k,chan in enumerate(chan_bins):
-				data_ant_xx = np.mean(np.array(pt.tablecolumn(t_ant, 'XXPOL'))[:, chan[0]:chan[1], :], axis=1)
-				auto_corr_xx_ant = np.reshape(data_ant_xx, len(data_ant_xx))
-				data_ant_xy = np.mean(np.array(pt.tablecolumn(t_ant, 'XYPOL'))[:, chan[0]:chan[1], :], axis=1)
-				auto_corr_xy_ant = np.reshape(data_ant_xy, len(data_ant_xy))
-				data_ant_yx = np.mean(np.array(pt.tablecolumn(t_ant, 'YXPOL'))[:, chan[0]:chan[1], :], axis=1)
-				auto_corr_yx_ant = np.reshape(data_ant_yx, len(data_ant_yx))
-				data_ant_yy = np.mean(np.array(pt.tablecolumn(t_ant, 'YYPOL'))[:, chan[0]:chan[1], :], axis=1)
-				auto_corr_yy_ant = np.reshape(data_ant_yy, len(data_ant_yy))
-				df['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_xx_antenna_' + str(i)] = auto_corr_xx_ant[:time_steps-3]
-				df['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_xy_antenna_' + str(i)] = auto_corr_xy_ant[:time_steps-3]
-				df['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_yx_antenna_' + str(i)] = auto_corr_yx_ant[:time_steps-3]
-				df['auto_corr_beam_' + str(j) + '_freq_' + str(k) + '_yy_antenna_' + str(i)] = auto_corr_yy_ant[:time_steps-3]
-
-	return df
-
-
-def data_to_csv(data_location, task_id, chan_range, bin_num):
+
+def output_files(data_location, task_id, output_format='csv'):
+	"""
+	The files that data_to_csv writes for a task.
+	"""
+	output_path = data_location + task_id + '/'
+	outputs = [output_path + task_id + '_hadec.csv']
+	if output_format in ['store', 'both']:
+		outputs.append(drift_store.store_path(data_location, task_id))
+	if output_format in ['csv', 'both']:
+		outputs.append(output_path + task_id + '_exported_data_frequency_split.csv')
+
+	return outputs
+
+
+def task_manifest(data_location, task_id, chan_range, bin_num, exclude='', read_pols=pols, per_antenna=True):
+	"""
+	The ExtractionManifest of a task for these extraction settings.
+	The selection of polarisations and antennas is only recorded if it is not the full extraction,
+	so the manifests of earlier (full) extractions stay valid.
+	"""
+	settings = {'chan_range': list(chan_range), 'bin_num': bin_num, 'exclude': exclude}
+	if list(read_pols) != pols:
+		settings['pols'] = list(read_pols)
+	if not per_antenna:
+		settings['per_antenna'] = False
+	return ExtractionManifest(manifest_path(data_location, task_id), settings)
+
+
+def task_complete(data_location, task_id, chan_range, bin_num, exclude='', output_format='csv', read_pols=pols,
+				  per_antenna=True):
+	"""
+	True if the task has been extracted before with the same settings and the requested outputs
+	still exist. Such a task does not need to be copied from the archive again.
+	"""
+	if data_location[-1] != '/':
+		data_location += '/'
+	manifest = task_manifest(data_location, task_id, chan_range, bin_num, exclude=exclude, read_pols=read_pols,
+							 per_antenna=per_antenna)
+	outputs = [os.path.abspath(output) for output in output_files(data_location, task_id, output_format)]
+
+	return manifest.complete() and all(output in manifest.outputs for output in outputs)
+
+
+def task_resumable(data_location, task_id, chan_range, bin_num, exclude='', read_pols=pols, per_antenna=True):
+	"""
+	True if the MS files of an interrupted task are still on disk and the manifest has beams that were
+	extracted with the same settings. Such a task does not need to be copied from the archive again:
+	a new copy would not change the data, only the beams that are missing still have to be extracted.
+	"""
+	if data_location[-1] != '/':
+		data_location += '/'
+	if not any(os.path.isdir(ms_name(data_location, task_id, beam)) for beam in range(40)):
+		return False
+	manifest = task_manifest(data_location, task_id, chan_range, bin_num, exclude=exclude, read_pols=read_pols,
+							 per_antenna=per_antenna)
+	return len(manifest.beams) > 0
+
+
+def data_to_csv(data_location, task_id, chan_range, bin_num, chunk_rows=120, workers=1, output_format='csv',
+				exclude='', resume=True, read_pols=pols, per_antenna=True):
 	"""
 	- Extract data on the observed field into a csv file. This is later used to calculate coordinates.
-	- Extract auto correlation data with the "extract_data" function. 
-	- Write the extracted data into csv files.
+	- Extract auto correlation data with the "extract_cube" function. 
+	- Write the extracted data into the binary store (modules/drift_store.py) and/or csv files.
 	
 	data_location: string
 	task_id: string
 	chan_range: rfi free channel range. A list with 2 numbers [x1,x2] 
 	bin_num: number of bins (integer)
+	chunk_rows: number of MS rows to read at once (integer)
+	workers: number of beams to extract in parallel (integer)
+	output_format: 'csv' (the _exported_data_frequency_split.csv table that the notebooks and plots read), 'store' or 'both'
+	exclude: a string with instructions for taql to exclude data from the compound beam,
+			 e.g. 'AND ANTENNA1!= 11 AND ANTENNA2!=11 AND ANTENNA1!= 10 AND ANTENNA2!=10'
+	resume: if True, only extract the beams that are not in the manifest of the task yet (see task_complete)
+	read_pols: the polarisations to extract, e.g. ['xx', 'yy'] (the beam maps only use these two)
+	per_antenna: also extract the data per antenna, otherwise only the compound beams
 	""" 
 	
 	print('test', data_location)
@@ -96,6 +320,11 @@ def data_to_csv(data_location, task_id, chan_range, bin_num):
 	if data_location[-1] != '/':
 		data_location += '/'
 
+	if resume and task_complete(data_location, task_id, chan_range, bin_num, exclude=exclude,
+								output_format=output_format, read_pols=read_pols, per_antenna=per_antenna):
+		print('{} has already been extracted'.format(task_id))
+		return
+
 	output_path = data_location + task_id +'/'
 
 	if not os.path.exists(output_path):
@@ -122,16 +351,29 @@ def data_to_csv(data_location, task_id, chan_range, bin_num):
 	# count antennas in the MS file:
 	t_name = pt.taql('select NAME from {0}{1}/WSRTA{1}_B001.MS::ANTENNA'.format(data_location, task_id))
 	ant_names=t_name.getcol("NAME")
-	antennas = range(len(ant_names))
+	antennas = range(len(ant_names)) if per_antenna else []
 	
-	exclude = ''
-	# exclude = 'AND ANTENNA1!= 11 AND ANTENNA2!=11 AND ANTENNA1!= 10 AND ANTENNA2!=10'
 	total_chan_num = chan_range[1] - chan_range[0]
 	bin_size = int(total_chan_num / bin_num)
 	chan_bins = []
 	for i in range(0, int(chan_range[1]-bin_size), bin_size):
 		chan_bins.append([i, i + 1050])
 
-	df_1 = extract_data(antennas, beams, chan_range, chan_bins, exclude, data_location, task_id)
-	df_1.to_csv(str(output_path) + str(task_id) + '_exported_data_frequency_split.csv')
+	if not resume and os.path.exists(manifest_path(data_location, task_id)):
+		os.remove(manifest_path(data_location, task_id))
+	manifest = task_manifest(data_location, task_id, chan_range, bin_num, exclude=exclude, read_pols=read_pols,
+							 per_antenna=per_antenna)
+
+	times, cube = extract_cube(antennas, beams, chan_range, chan_bins, exclude, data_location, task_id,
+							   chunk_rows=chunk_rows, workers=workers, manifest=manifest, read_pols=read_pols)
+
+	# The store records the antennas and polarisations that were extracted (no antennas for the compound beams only)
+	if output_format in ['store', 'both']:
+		drift_store.write_store(drift_store.store_path(data_location, task_id), times,
+								np.column_stack([ha, dec]), cube, beams, antennas, read_pols, task_id=task_id,
+								chan_range=list(chan_range), chan_bins=chan_bins, per_antenna=per_antenna)
+	if output_format in ['csv', 'both']:
+		df_1 = cube_to_dataframe(times, cube, antennas, beams, read_pols=read_pols)
+		df_1.to_csv(str(output_path) + str(task_id) + '_exported_data_frequency_split.csv')
 
+	manifest.finish(output_files(data_location, task_id, output_format))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+This script writes the FITS files of the individual beams (and antennas) from the consolidated cube
+store of a date that is written by scan2fits.py -e cube. The FITS files have the same names and
+headers as the ones written by scan2fits.py directly, for the scripts that read them.
+
+input:
+- The date of the cube store
+
+Example: python export_cube_fits.py -d '190821' -c 'Cyg A'
+        python export_cube_fits.py -d '190821' -c 'Cyg A' -b '1,7'
+
+"""
+
+__author__ = "Helga Denes"
+__date__ = "$29-aug-2019 16:00:00$"
+__version__ = "0.1"
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+from modules.cube_store import CubeStore, cube_store_path
+from modules.fits_io import dtypes
+
+
+def parse_args():
+
+    parser = ArgumentParser(
+        description="Write the FITS files of the beams from a consolidated cube store",
+        formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('-c', '--calibname', default='Cyg A',
+                        help="Specify the calibrator. (default: '%(default)s').")
+    parser.add_argument('-o', '--basedir', default='/tank/apertif/driftscans/',
+                        help="Specify the root directory. \n(default: '%(default)s').")
+    parser.add_argument('-d', '--date', default="test",
+                        help="Date of the cube store. \n(default: '%(default)s').")
+    parser.add_argument('-b', '--beams', default=None,
+                        help="Specify the first and the last beam as a string. \n(default: all beams in the store).")
+    parser.add_argument('--dtype', default='float32', choices=sorted(dtypes),
+                        help="Data type of the FITS files. \n(default: '%(default)s', as in the store).")
+    parser.add_argument('--compress', action='store_true',
+                        help="Write lossless tile compressed FITS files.")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    args = parse_args()
+
+    store = CubeStore(cube_store_path(args.basedir, args.date, args.calibname))
+    beams = None
+    if args.beams is not None:
+        beam_range = args.beams.split(',')
+        beams = [b for b in range(int(beam_range[0]), int(beam_range[1])+1) if b in store.beams]
+
+    print("Writing the FITS files of {}".format(store.path))
+    store.export_fits(args.basedir, beams=beams, date=args.date, calibname=args.calibname, dtype=args.dtype,
+                      compress=args.compress)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+This script fits an analytic profile (an elliptical Gaussian or cos^n, with the squint as the centre) to
+the main lobe of every beam, polarisation and frequency bin of the beam cubes made by scan2fits.py. All
+beams are fitted together, bin by bin, with the fits of a bin as the start values of the next one (see
+modules/beam_fits.py). The parameters are written to one small table per date, that
+modules.beam_fits.BeamParameters evaluates on any grid.
+
+input:
+- A date that has beam fits files in the base directory /tank/apertif/driftscans/
+
+Example: python fit_beam_profiles.py -d '190821' -c 'Cyg A'
+        python fit_beam_profiles.py -d '190821' -c 'Cyg A' -p cosn -n 6
+
+"""
+
+__author__ = "Helga Denes"
+__date__ = "$29-aug-2019 16:00:00$"
+__version__ = "0.1"
+
+import os
+import time
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+import numpy as np
+
+from modules.beam_fits import fit_cubes, get_profile, profiles, read_cube, write_parameters
+from modules.cube_store import fits_path
+
+
+def parse_args():
+
+    parser = ArgumentParser(
+        description="Fit an analytic profile to the main lobe of all beams",
+        formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('-c', '--calibname', default='Cyg A',
+                        help="Specify the calibrator. (default: '%(default)s').")
+    parser.add_argument('-o', '--basedir', default='/tank/apertif/driftscans/',
+                        help="Specify the root directory. \n(default: '%(default)s').")
+    parser.add_argument('-d', '--date', default="test",
+                        help="Date of the beam cubes. \n(default: '%(default)s').")
+    parser.add_argument('-b', '--beams', default='0,39',
+                        help="Specify the first and the last beam as a string. \n(default: '%(default)s').")
+    parser.add_argument('-p', '--profile', default='gaussian', choices=sorted(profiles),
+                        help="Beam profile. \n(default: '%(default)s').")
+    parser.add_argument('-n', '--power', default=6, type=int,
+                        help="Power of the cos^n profile. \n(default: '%(default)s').")
+    parser.add_argument('-l', '--level', default=0.2, type=float,
+                        help="Fit the pixels above this fraction of the peak. \n(default: '%(default)s').")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    start = time.time()
+    args = parse_args()
+    date = args.date
+    beam_range = args.beams.split(',')
+    beams = range(int(beam_range[0]), int(beam_range[1])+1)
+    profile = get_profile(args.profile, args.power)
+
+    # All beams and polarisations are one batch, of full cutouts with the bins of the first cube
+    px_width = 20
+    keys, cubes, freqs, nbins = [], [], None, None
+    for pol in ['I', 'xx', 'yy']:
+        for beam in beams:
+            path = fits_path(args.basedir, date, args.calibname, beam) + '_{}.fits'.format(pol)
+            if not os.path.exists(path):
+                print('Skipping beam {} ({}), no file {}'.format(beam, pol, path))
+                continue
+            u, v, maps, header = read_cube(path, px_width)
+            if maps.shape[1] != (2 * px_width)**2:
+                print('Skipping beam {} ({}), the cutout does not fit in the map'.format(beam, pol))
+                continue
+            if nbins is not None and maps.shape[0] != nbins:
+                print('Skipping beam {} ({}), {} frequency bins instead of {}'.format(beam, pol, maps.shape[0], nbins))
+                continue
+            if freqs is None:
+                nbins = maps.shape[0]
+                freqs = header['CRVAL3'] + header['CDELT3'] * (np.arange(maps.shape[0]) + 1 - header['CRPIX3'])
+            keys.append((beam, pol))
+            cubes.append((u, v, maps))
+
+    if not cubes:
+        print('No beam cubes found for {}'.format(date))
+        return
+
+    print('Fitting a {} profile to {} cubes'.format(profile.name, len(cubes)))
+    params, rms, converged = fit_cubes(profile, cubes, level=args.level)
+
+    rows = []
+    for i, (beam, pol) in enumerate(keys):
+        for chan in range(len(freqs)):
+            rows.append((beam, pol, chan, freqs[chan], profile.name) + tuple(params[chan, i]) +
+                        (profile.n, rms[chan, i], converged[chan, i]))
+    path = os.path.join(args.basedir, 'spline', date, 'beam_params_{}_{}.csv'.format(profile.name, date))
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    write_parameters(path, rows)
+
+    print('{} of {} fits converged, median rms {:.2e}'.format(converged.sum(), converged.size, np.median(rms)))
+    print('Parameters written to {}'.format(path))
+    print('Time [minutes]: ', (time.time() - start)/60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+This script makes the primary beam corrected mosaic (linear mosaic, as MIRIAD linmos) of the images or
+cubes of the beams, with the beam models of make_beam_model.py. It also writes the weight map of the
+mosaic. With one beam it makes the primary beam corrected image of that beam.
+
+The cubes are read plane by plane and the sums are kept on disk, so the memory use does not depend on
+the size of the cubes (see modules/linmos.py).
+
+input:
+- The date of the beam models
+- A pattern for the image or cube of each beam, formatted with the beam number
+
+Example: python linmos_beams.py -d '201028' -i /tank/denes/HI/cube_b{:02}.fits -m /tank/denes/HI/mosaic
+        python linmos_beams.py -d '201028' -i /tank/denes/continuum_images/continuum_b{:02}.fits -b '0,0' -m ./b00
+
+"""
+
+__author__ = "Helga Denes"
+__date__ = "$29-aug-2019 16:00:00$"
+__version__ = "0.1"
+
+from glob import glob
+import os
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from astropy.io import fits
+
+from modules.fits_io import image_hdu
+from modules.linmos import LinmosInput, grid_header, linmos, mosaic_header, read_beam_models
+
+
+def parse_args():
+
+    parser = ArgumentParser(
+        description="Primary beam correct and mosaic the images or cubes of the beams",
+        formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('-o', '--basedir', default='/tank/apertif/driftscans/',
+                        help="Specify the root directory. \n(default: '%(default)s').")
+    parser.add_argument('-d', '--date', default="test",
+                        help="Date of the beam models. \n(default: '%(default)s').")
+    parser.add_argument('-i', '--images', required=True,
+                        help="Pattern of the images or cubes of the beams, e.g. cube_b{:02}.fits")
+    parser.add_argument('-b', '--beams', default='0,39',
+                        help="Specify the first and the last beam as a string. \n(default: '%(default)s').")
+    parser.add_argument('-m', '--mosaic', default='mosaic',
+                        help="Output name, <mosaic>.fits and <mosaic>_weights.fits. \n(default: '%(default)s').")
+    parser.add_argument('-t', '--template', default=None,
+                        help="Image with the grid of the mosaic. \n(default: a grid that covers all images).")
+    parser.add_argument('-p', '--pol', default='I',
+                        help="Polarisation of the beam models. \n(default: '%(default)s').")
+    parser.add_argument('--cutoff', default=0.1, type=float,
+                        help="Leave out the pixels where the beam is below this level. \n(default: '%(default)s').")
+    parser.add_argument('--flip', action='store_true',
+                        help="Flip the beam models upside down first (for the old beam models).")
+    parser.add_argument('--tmpdir', default=None,
+                        help="Directory for the temporary sums, as large as the mosaic. \n(default: next to the mosaic).")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    args = parse_args()
+    date = args.date
+    beam_range = args.beams.split(',')
+    beams = range(int(beam_range[0]), int(beam_range[1])+1)
+
+    inputs = []
+    for beam in beams:
+        path = args.images.format(beam)
+        models = sorted(glob(os.path.join(args.basedir, 'fits_files', date, 'beam_models', 'chann_*',
+                                          '{}_{:02}_{}_model.fits'.format(date, beam, args.pol))))
+        if not os.path.exists(path):
+            print('Skipping beam {}, no image {}'.format(beam, path))
+            continue
+        if not models:
+            print('Skipping beam {}, no beam models for {}'.format(beam, date))
+            continue
+        freqs, beam_models, model_header = read_beam_models(models, flip=args.flip)
+        inputs.append(LinmosInput(path, freqs, beam_models, model_header))
+
+    if args.template is not None:
+        hdu = fits.open(args.template)
+        header = grid_header(image_hdu(hdu).header)
+        hdu.close()
+    else:
+        header = mosaic_header([inp.header for inp in inputs])
+
+    print('Mosaicking {} beams on a {}x{} pixel grid'.format(len(inputs), header['NAXIS1'], header['NAXIS2']))
+    linmos(inputs, header, args.mosaic + '.fits', args.mosaic + '_weights.fits', cutoff=args.cutoff,
+           tmpdir=args.tmpdir)
+
+
+if __name__ == '__main__':
+    main()
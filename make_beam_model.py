@@ -18,16 +18,11 @@ Example: python make_beam_model.py -d '190303' -c 'Cas A'
 
 
 from glob import glob
-
-from scipy.interpolate import RectBivariateSpline
-from astropy.io import fits
-import matplotlib.pyplot as plt
-import numpy as np
-import os
-from numpy import arange
-import pandas as pd
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+from modules.fits_io import dtypes
+from modules.spline_models import CutoutCache, spline_model, write_model_fits
+
 
 def parse_args():
 
@@ -45,6 +40,10 @@ def parse_args():
                         help="Number of frequency bins. \n(default: '%(default)s').")  
     parser.add_argument('-d', '--date', default="test",
                         help="Output name. \n(default: '%(default)s').")                      
+    parser.add_argument('--dtype', default='float64', choices=sorted(dtypes),
+                        help="Data type of the FITS files. \n(default: '%(default)s').")
+    parser.add_argument('--compress', action='store_true',
+                        help="Write lossless tile compressed FITS files.")
                         
 
     args = parser.parse_args()
@@ -59,56 +58,29 @@ def main():
 	
 	polarisation = ['I', 'xx', 'yy']
 
+	# Every cube is read once, the cutouts of all channels are taken from the same read
+	cache = CutoutCache(px_width=20)
+
 	for pol in polarisation:
 		files=glob('{}fits_files/{}/{}_{}_*_{}.fits'.format(basedir, date, calib.replace(' ',''), date, pol))
 		files.sort()
 
-		hdu=fits.open(files[0])
-		beam=hdu[0].data
-		h_measured = hdu[0].header
-		f0=hdu[0].header['CRVAL3']
-		fdelt=hdu[0].header['CDELT3']
-		hdu.close()
-		px_width = 20
+		h_measured = cache.header(files[0])
+		f0=h_measured['CRVAL3']
+		fdelt=h_measured['CDELT3']
 
 		for chan in range(1,10):
 		#for chan in range(0,18):
 
 			freq = f0 + fdelt * chan
-			bmap, fbeam = [], []
 
 			for i,t in enumerate(files):
-				hdu=fits.open(t)
-				beam=hdu[0].data
-				beam = np.nan_to_num(beam)
-				hdu.close()
-				bmap.append(np.flipud(beam[chan,int(hdu[0].header['CRPIX2'])-px_width:int(hdu[0].header['CRPIX2'])+px_width,
-							 int(hdu[0].header['CRPIX1'])-px_width:int(hdu[0].header['CRPIX1'])+px_width]))
-				x=arange(0,bmap[i].shape[1])
-				y=arange(0,bmap[i].shape[0])
-				fbeam.append(RectBivariateSpline(y,x,bmap[i]))  # spline interpolation
-
-				h_measured['NAXIS1'] = int(px_width * 2)
-				h_measured['NAXIS2'] = int(px_width * 2)
-				h_measured['NAXIS3'] = 1
-				h_measured['CRPIX1'] = px_width
-				h_measured['CRPIX2'] = px_width
-			
-				h_measured['CRVAL3'] = freq
-				header = h_measured
-
-				hduI = fits.PrimaryHDU(fbeam[i](y,x), header=h_measured)
-		
-				if not os.path.exists(basedir + 'fits_files/{}/beam_models'.format(date)):
-					os.mkdir(basedir + 'fits_files/{}/beam_models'.format(date))
-			
-				if not os.path.exists(basedir + 'fits_files/{}/beam_models/chann_{}'.format(date, chan)):
-					os.mkdir(basedir + 'fits_files/{}/beam_models/chann_{}'.format(date, chan))
-
-				hduI.writeto(basedir + 'fits_files/{}/beam_models/chann_{}/{}_{:02}_{}_model.fits'.format(date, chan, date, i, pol), overwrite=True)
-			
-		
+				model = spline_model(cache.cutouts(t)[chan])  # spline interpolation
+				write_model_fits(basedir + 'fits_files/{}/beam_models/chann_{}/{}_{:02}_{}_model.fits'.format(date, chan, date, i, pol),
+								 model, h_measured, freq, px_width=cache.px_width, dtype=args.dtype, compress=args.compress)
 
+		# The cutouts of this polarisation are not needed anymore
+		cache.clear()
 
 
 if __name__ == '__main__':
@@ -8,26 +8,27 @@ __version__ = "0.2"
 """
 This program will read Apertif FITS files containing one beam map and fit them with RectBivariateSpline. 
 The resulting spline fits are written into a .csv file and 9 times 40 fits files. One fits file for each beam at each of the 9 frequency bins.
+All frequency bins of a cube are fitted in one job, and the jobs can run in parallel (-w). Missing and failed
+cubes are listed in a report (<calibrator>_<date>_ant_models.csv next to the fits files).
 
 input: 
 A date that has beam fits files in the base directory /tank/apertif/driftscans/
 
 Example: python make_beam_model_ant.py -d '190303' -c 'Cas A' 
+         python make_beam_model_ant.py -d '190303' -c 'Cas A' -w 8
 
 """
 
 
-from glob import glob
-
-from scipy.interpolate import RectBivariateSpline
-from astropy.io import fits
-import matplotlib.pyplot as plt
-import numpy as np
 import os
-from numpy import arange
 import pandas as pd
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+from modules.cube_store import fits_path
+from modules.fits_io import dtypes
+from modules.parallel import map_jobs
+from modules.spline_models import antenna_model, init_antenna_worker
+
 
 def parse_args():
 
@@ -41,70 +42,66 @@ def parse_args():
                         help="Specify the root directory. \n(default: '%(default)s').")
     parser.add_argument('-b', '--beams', default='0,39',
                         help="Specify the first and the last beam as a string. \n(default: '%(default)s').")  
-    parser.add_argument('-n', '--bin_num', default=10,
+    parser.add_argument('-n', '--bin_num', default=10, type=int,
                         help="Number of frequency bins. \n(default: '%(default)s').")  
     parser.add_argument('-d', '--date', default="test",
                         help="Output name. \n(default: '%(default)s').")                      
+    parser.add_argument('--dtype', default='float64', choices=sorted(dtypes),
+                        help="Data type of the FITS files. \n(default: '%(default)s').")
+    parser.add_argument('--compress', action='store_true',
+                        help="Write lossless tile compressed FITS files.")
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help="Number of parallel processes for the models. \n(default: '%(default)s').")
                         
 
     args = parser.parse_args()
     return args
 
+def write_report(path, report):
+	"""
+	Write the status of every antenna and beam, and print a summary of the missing and failed ones.
+	"""
+	report = pd.DataFrame(report, columns=['antenna', 'beam', 'status', 'message'])
+	report.to_csv(path, index=False)
+
+	for status in ['missing', 'failed']:
+		rows = report[report['status'] == status]
+		for ant, beams in rows.groupby('antenna')['beam']:
+			print('Antenna {}: {} beams {}: {}'.format(ant, len(beams), status, ', '.join(str(b) for b in beams)))
+	print('{} of {} models made, report written to {}'.format((report['status'] == 'ok').sum(), len(report), path))
+
+
 def main():
     
 	args = parse_args()
 	basedir = args.basedir
 	date = args.date
 	calib = args.calibname
+	beam_range = args.beams.split(',')
+	beams = range(int(beam_range[0]), int(beam_range[1])+1)
 
+	# Find the Stokes I cubes of all antennas and beams first, the missing ones go straight into the report
+	jobs, report = [], []
 	for ant in range(0,12):
-		try:
-			print('Spline interpolating antenna: ', ant)
-			files=glob('{}fits_files/{}/ant_{}/{}_{}_*_I.fits'.format(basedir, date, ant, calib.replace(' ',''), date))			
-			files.sort()
-
-			# loop trough all 40 beams
-			for k in range(40):
-				hdu=fits.open(files[k])
-				beam=hdu[0].data
-				h_measured = hdu[0].header
-				f0=hdu[0].header['CRVAL3']
-				fdelt=hdu[0].header['CDELT3']
-				px_width = 20
-								
-				#hdu.close()
-		
-				model = []
-		
-				# loop trough all frequency chunks
-				for chan in range(0,10):
-
-					freq = f0 + fdelt * chan
-					bmap, fbeam = [], []
-		
-					bmap = np.flipud(beam[chan,int(hdu[0].header['CRPIX2'])-px_width:int(hdu[0].header['CRPIX2'])+px_width, int(hdu[0].header['CRPIX1'])-px_width:int(hdu[0].header['CRPIX1'])+px_width])				
-					x=arange(0,px_width * 2)
-					y=arange(0,px_width * 2)
-					fbeam.append(RectBivariateSpline(y,x,bmap))  # spline interpolation
-					model.append(np.flipud(fbeam[0](x,y))) # 40x40 pixel model
-
-				h_measured['NAXIS1'] = int(px_width * 2)
-				h_measured['NAXIS2'] = int(px_width * 2)
-				h_measured['CRPIX1'] = px_width
-				h_measured['CRPIX2'] = px_width
-
-				hduI = fits.PrimaryHDU(model, header=h_measured)
-		
-				if not os.path.exists(basedir + 'fits_files/{}/ant_{}/beam_models'.format(date, ant)):
-					os.mkdir(basedir + 'fits_files/{}/ant_{}/beam_models'.format(date, ant))
-		
-
-				hduI.writeto(basedir + 'fits_files/{}/ant_{}/beam_models/{}_{:02}_I_model.fits'.format(date, ant, date, k), overwrite=True)
-		
-		except Exception as e:
-			print('There is no data for antenna: {}'.format(ant))
-			continue
-
+		for beam in beams:
+			path = fits_path(basedir, date, calib, beam, ant) + '_I.fits'
+			if os.path.exists(path):
+				jobs.append((ant, beam, path))
+			else:
+				report.append((ant, beam, 'missing', 'no file {}'.format(path)))
+
+	# One job fits all frequency chunks of one cube
+	print('Spline interpolating {} cubes of {} antennas'.format(len(jobs), len(set(job[0] for job in jobs))))
+	results = map_jobs(antenna_model, jobs, workers=args.workers, initializer=init_antenna_worker,
+					   initargs=(basedir, date, list(range(args.bin_num)), 20, args.dtype, args.compress))
+	for ant, beam, status, message in results:
+		if status != 'ok':
+			print('Antenna {}, beam {}: {}'.format(ant, beam, message))
+		report.append((ant, beam, status, message))
+
+	report.sort(key=lambda row: (row[0], row[1]))
+	write_report(os.path.join(basedir, 'fits_files', date, '{}_{}_ant_models.csv'.format(calib.replace(' ',''), date)),
+				 report)
 
 
 if __name__ == '__main__':
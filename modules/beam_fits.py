@@ -0,0 +1,283 @@
+"""
+Parametric fits of the beam maps: an analytic profile per beam, polarisation and frequency bin.
+
+The profiles are functions of the offsets (u, v) in degrees from the reference pixel of the maps (the
+calibrator), so a fit evaluates to a beam on any grid at once:
+- gaussian: amp * exp(-((a / w1)**2 + (b / w2)**2) / 2), i.e. w1, w2 are the sigmas
+- cosn: amp * cos(pi / 2 * min(r, 1))**n, with r = sqrt((a / w1)**2 + (b / w2)**2), i.e. w1, w2 are the
+  radii of the first null
+where (a, b) are the offsets from the centre (x0, y0) of the beam, rotated by theta. The centre is the
+squint of the beam.
+
+All beams (and polarisations) of a frequency bin are fitted together with a batched Levenberg-Marquardt
+least-squares fit, and the fits of a bin are the start values of the next bin. Only the main lobe
+(the pixels above a level of the peak) is fitted.
+"""
+
+import abc
+
+import numpy as np
+import pandas as pd
+
+from modules.spline_models import read_cutouts
+
+columns = ['beam', 'pol', 'chan', 'freq', 'profile', 'amp', 'x0', 'y0', 'w1', 'w2', 'theta', 'n', 'rms', 'converged']
+
+
+class Profile(abc.ABC):
+    """
+    An analytic beam profile with parameters (amp, x0, y0, w1, w2, theta). The profiles implement _shape.
+    """
+    name = None
+    names = ['amp', 'x0', 'y0', 'w1', 'w2', 'theta']
+
+    def __init__(self, n=None):
+        self.n = n
+
+    def evaluate(self, params, u, v):
+        """
+        params: shape (..., 6)
+        u, v: offsets in degrees, broadcast against params[..., 0]
+        """
+        params = np.asarray(params, dtype=np.float64)
+        amp, x0, y0, w1, w2, theta = [params[..., i, None] for i in range(6)]
+        du, dv = u - x0, v - y0
+        a = du * np.cos(theta) + dv * np.sin(theta)
+        b = -du * np.sin(theta) + dv * np.cos(theta)
+        return amp * self._shape((a / w1)**2 + (b / w2)**2)
+
+    @abc.abstractmethod
+    def _shape(self, r2):
+        """
+        The profile as a function of the squared elliptical radius r2, 1 at the centre.
+        """
+
+    def initial(self, data, u, v):
+        """
+        Start values from the moments of the maps, data, u, v: shape (batch, pixels), NaN outside the main lobe.
+        """
+        weights = np.where(np.isfinite(data), np.maximum(data, 0), 0)
+        total = np.sum(weights, axis=1)
+        x0 = np.sum(weights * u, axis=1) / total
+        y0 = np.sum(weights * v, axis=1) / total
+        sx = np.sqrt(np.sum(weights * (u - x0[:, None])**2, axis=1) / total)
+        sy = np.sqrt(np.sum(weights * (v - y0[:, None])**2, axis=1) / total)
+        amp = np.nanmax(data, axis=1)
+        return np.column_stack([amp, x0, y0, sx, sy, np.zeros(len(amp))])
+
+
+class Gaussian(Profile):
+    name = 'gaussian'
+
+    def _shape(self, r2):
+        return np.exp(-0.5 * r2)
+
+    def initial(self, data, u, v):
+        # The moments of the lobe down to a level underestimate the width
+        params = super(Gaussian, self).initial(data, u, v)
+        params[:, 3:5] *= 1.5
+        return params
+
+
+class CosN(Profile):
+    name = 'cosn'
+
+    def _shape(self, r2):
+        return np.cos(np.pi / 2 * np.minimum(np.sqrt(r2), 1))**self.n
+
+    def initial(self, data, u, v):
+        params = super(CosN, self).initial(data, u, v)
+        params[:, 3:5] *= 4.
+        return params
+
+
+profiles = {'gaussian': Gaussian, 'cosn': CosN}
+
+
+def get_profile(name, n=6):
+    return profiles[name](int(n)) if name == 'cosn' else profiles[name]()
+
+
+def fit_batch(profile, u, v, data, p0, iterations=100, tolerance=1e-10, gtol=1e-6, xtol=1e-8):
+    """
+    Levenberg-Marquardt fit of a profile to a batch of maps at once.
+
+    u, v: offsets of the pixels in degrees, shape (batch, pixels)
+    data: the maps, shape (batch, pixels), NaN for the pixels that are not fitted
+    p0: start values, shape (batch, 6)
+    tolerance: converged when a step lowers the cost by less than this fraction
+    gtol, xtol: when no better step is found at the largest damping, the fit is still converged if the gradient
+                (the cosine between the residuals and the columns of the Jacobian) is below gtol, or the last step
+                changed the parameters by less than xtol, e.g. a fit that starts at the minimum
+    returns: parameters (batch, 6), rms of the residuals (batch), converged (batch). A fit that stalls (no
+             better step at the largest damping, away from a minimum) or runs out of iterations is not converged.
+    """
+    fitted = np.isfinite(data)
+    data = np.where(fitted, data, 0)
+    params = np.array(p0, dtype=np.float64)
+    batch, npar = params.shape
+    damping = np.full(batch, 1e-3)
+    converged = np.zeros(batch, dtype=bool)
+    stalled = np.zeros(batch, dtype=bool)
+    last_step = np.full(batch, np.inf)
+
+    def residuals(p):
+        return np.where(fitted, profile.evaluate(p, u, v) - data, 0)
+
+    res = residuals(params)
+    cost = np.sum(res**2, axis=1)
+    for i in range(iterations):
+        # Jacobian by forward differences, shape (batch, pixels, parameters)
+        step = 1e-7 * np.maximum(np.abs(params), 1e-4)
+        jac = np.empty(res.shape + (npar,))
+        for k in range(npar):
+            shifted = params.copy()
+            shifted[:, k] += step[:, k]
+            jac[:, :, k] = (residuals(shifted) - res) / step[:, k, None]
+
+        jtj = np.einsum('bpi,bpj->bij', jac, jac)
+        grad = np.einsum('bpi,bp->bi', jac, res)
+        diag = np.einsum('bii->bi', jtj)
+        system = jtj + damping[:, None, None] * (np.eye(npar) * np.maximum(diag, 1e-12)[:, None, :])
+        try:
+            delta = -np.linalg.solve(system, grad[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            delta = -np.array([np.linalg.lstsq(s, g, rcond=None)[0] for s, g in zip(system, grad)])
+
+        trial = params + delta
+        trial_res = residuals(trial)
+        trial_cost = np.sum(trial_res**2, axis=1)
+        better = (trial_cost < cost) & ~(converged | stalled)
+        done = better & (cost - trial_cost <= tolerance * np.maximum(cost, 1e-30))
+
+        last_step[better] = np.max(np.abs(delta[better]) / np.maximum(np.abs(params[better]), 1e-4), axis=1)
+        params[better] = trial[better]
+        res[better] = trial_res[better]
+        cost[better] = trial_cost[better]
+        damping = np.where(better, damping / 10, np.minimum(damping * 10, 1e10))
+        converged |= done
+
+        # The gradient and the parameters have not changed for the fits without a better step
+        capped = ~(converged | stalled) & (damping >= 1e10)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cosine = np.max(np.abs(grad) / np.sqrt(diag * cost[:, None]), axis=1)
+        minimum = (cost == 0) | (cosine <= gtol) | (last_step <= xtol)
+        converged |= capped & minimum
+        stalled |= capped & ~minimum
+        if (converged | stalled).all():
+            break
+
+    # Positive widths with w1 the major axis, and the position angle of the major axis in [-pi/2, pi/2)
+    params[:, 3:5] = np.abs(params[:, 3:5])
+    swap = params[:, 3] < params[:, 4]
+    params[swap, 3:5] = params[swap, 4:2:-1]
+    params[swap, 5] += np.pi / 2
+    params[:, 5] = (params[:, 5] + np.pi / 2) % np.pi - np.pi / 2
+    rms = np.sqrt(cost / np.maximum(fitted.sum(axis=1), 1))
+    return params, rms, converged
+
+
+def read_cube(path, px_width=20):
+    """
+    The [CRPIX - px_width:CRPIX + px_width] cutouts of all bins of a beam cube, with the offsets of their
+    pixels in degrees from the reference pixel.
+
+    returns: u, v with shape (pixels), maps with shape (bin, pixels), header of the cube
+    """
+    cutouts, header = read_cutouts(path, px_width, nan_to_num=False, flip=False)
+    rows, cols = np.indices(cutouts.shape[1:])
+    u = (int(header['CRPIX1']) - px_width + cols + 1 - header['CRPIX1']) * header['CDELT1']
+    v = (int(header['CRPIX2']) - px_width + rows + 1 - header['CRPIX2']) * header['CDELT2']
+    return u.ravel(), v.ravel(), cutouts.reshape(len(cutouts), -1), header
+
+
+def fit_cubes(profile, cubes, level=0.2, iterations=100):
+    """
+    Fit all frequency bins of a batch of cubes, with the fits of a bin as the start values of the next.
+
+    cubes: list of (u, v, cube), with the offsets in degrees of the pixels (pixels) and the maps (bin, pixels)
+    level: only fit the pixels above this fraction of the peak of every map
+    returns: parameters (bin, batch, 6), rms (bin, batch), converged (bin, batch)
+    """
+    u = np.array([c[0] for c in cubes])
+    v = np.array([c[1] for c in cubes])
+    data = np.array([c[2] for c in cubes], dtype=np.float64)        # shape (batch, bin, pixels)
+    nbins = data.shape[1]
+
+    params = np.zeros((nbins, len(cubes), 6))
+    rms = np.zeros((nbins, len(cubes)))
+    converged = np.zeros((nbins, len(cubes)), dtype=bool)
+    p0 = None
+    for b in range(nbins):
+        maps = data[:, b]
+        with np.errstate(invalid='ignore'):
+            peak = np.nanmax(maps, axis=1)
+            lobe = np.where(maps >= level * peak[:, None], maps, np.nan)
+        if p0 is None:
+            p0 = profile.initial(lobe, u, v)
+        params[b], rms[b], converged[b] = fit_batch(profile, u, v, lobe, p0, iterations=iterations)
+        p0 = params[b]
+    return params, rms, converged
+
+
+def write_parameters(path, rows):
+    """
+    rows: (beam, pol, chan, freq, profile, amp, x0, y0, w1, w2, theta, n, rms, converged)
+    """
+    pd.DataFrame(rows, columns=columns).to_csv(path, index=False)
+
+
+class BeamParameters(object):
+    """
+    The parameter table of a date, evaluated on demand.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.table = pd.read_csv(path)
+        self.params = self.table[Profile.names].values.astype(np.float64)
+        self.profiles = [get_profile(name, n) for name, n in zip(self.table['profile'], self.table['n'])]
+        self._index = dict(((row.beam, row.pol, row.chan), i) for i, row in enumerate(self.table.itertuples()))
+
+    def index(self, beam, pol, chan):
+        try:
+            return self._index[(beam, pol, chan)]
+        except KeyError:
+            raise KeyError('No fit for beam {}, pol {} and channel {} in {}'.format(beam, pol, chan, self.path))
+
+    def evaluate(self, beam, pol, chan, u, v, grid=True):
+        """
+        u, v: offsets in degrees from the reference pixel of the maps
+        grid: evaluate on the grid of u and v and return shape (len(v), len(u)), else at the points (u, v)
+        """
+        i = self.index(beam, pol, chan)
+        u = np.asarray(u, dtype=np.float64)
+        v = np.asarray(v, dtype=np.float64)
+        if grid:
+            u, v = np.meshgrid(u, v)
+        return self.profiles[i].evaluate(self.params[i], u, v)
+
+
+def check_exact_fit(name='gaussian'):
+    """
+    Fit maps made with the profile itself, starting at the true parameters and at the moments of the maps. Every
+    fit has to come back converged, with the true parameters. Run with: python -m modules.beam_fits
+    """
+    profile = get_profile(name)
+    grid = (np.arange(40) - 20) * 0.05
+    u, v = [np.tile(a.ravel(), (2, 1)) for a in np.meshgrid(grid, grid)]
+    true = np.array([[1., 0.02, -0.03, 0.35, 0.3, 0.3], [0.9, -0.05, 0.01, 0.4, 0.38, -0.5]])
+    if name == 'cosn':
+        true[:, 3:5] *= 3
+    data = profile.evaluate(true, u, v)
+    data = np.where(data >= 0.2 * np.max(data, axis=1, keepdims=True), data, np.nan)
+    for p0 in [true, profile.initial(data, u, v)]:
+        params, rms, converged = fit_batch(profile, u, v, data, p0)
+        assert converged.all(), 'exact {} maps not converged'.format(name)
+        assert np.allclose(params, true, rtol=0, atol=1e-8), 'exact {} maps fitted wrongly'.format(name)
+
+
+if __name__ == '__main__':
+    for name in sorted(profiles):
+        check_exact_fit(name)
+        print('{}: exact maps converged'.format(name))
@@ -0,0 +1,203 @@
+"""
+Beam maps (normalised XX & YY cubes) of a compound beam and of the same beam of the individual
+antennas, from the drift scan samples of all tasks.
+
+The data that all beams share (the extracted data and the drift offsets of every task) is handed
+to each worker process once by init_worker, so that beam_cubes only needs the beam and the
+antennas of the job. The sample positions of a beam are the same for the compound beam and all
+antennas, so all maps of a beam are interpolated on one triangulation in one call (the antennas of which
+the quality screen left out drifts are interpolated in groups with the same drifts).
+"""
+
+import time
+
+import numpy as np
+
+from modules.drift_store import task_block
+from modules.gridding import CubicGridder, grid_axes, gridders, residuals
+
+_shared = {}
+
+
+def init_worker(data_tab, offsets, calib_dec, cell_size, freqchunks, crop=None, gridder='cubic', report=False):
+    """
+    data_tab: list with the extracted data of every task (see modules.drift_store.read_drift_data)
+    offsets: list with the drift offsets (x, y) of every task (see modules.drift_coords.task_offsets)
+    calib_dec: declination of the calibrator in apparent coordinates in degrees
+    cell_size: size of the map pixels in degrees
+    freqchunks: number of frequency bins
+    crop: only make the maps within crop pixels of the reference pixel (None for the full maps)
+    gridder: name of the gridding backend (see modules.gridding.gridders)
+    report: also make the maps with the cubic backend, and report the residuals against them
+    """
+    _shared.update({'data_tab': data_tab, 'offsets': offsets, 'calib_dec': calib_dec, 'cell_size': cell_size,
+                    'freqchunks': freqchunks, 'crop': crop, 'gridder': gridder, 'report': report})
+
+
+def crop_window(ref_pixx, ref_pixy, crop):
+    """
+    The cells [row0:row1, col0:col1] of the full map within crop pixels of the reference pixel, the same
+    region as the [CRPIX - crop:CRPIX + crop] slices of the spline fitting.
+    """
+    row0 = max(int(ref_pixy) - crop, 0)
+    col0 = max(int(ref_pixx) - crop, 0)
+    return row0, int(ref_pixy) + crop, col0, int(ref_pixx) + crop
+
+
+def beam_geometry(offsets, beam, calib_dec, cell_size, crop=None):
+    """
+    Sample positions and map geometry of one beam of all tasks, without any gridding.
+
+    returns: x, y: positions of the samples in one contiguous array each, shape (samples)
+             window: the part of the full map that is gridded (None for the full map)
+             ref_pixx, ref_pixy: the reference pixel of the calibrator in the (cropped) map, FITS indexed from 1
+             shape: (y, x) size of the (cropped) map
+    """
+    x = np.concatenate([x_task[beam] for x_task, y_task in offsets])
+    y = np.concatenate([np.full(len(x_task[beam]), y_task[beam]) for x_task, y_task in offsets])
+
+    # Find the reference pixel at the apparent coordinates of the calibrator
+    ref_pixy = (calib_dec - min(y)) / cell_size + 1      # FITS indexed from 1
+    ref_pixx = (-min(x)) / cell_size + 1                 # FITS indexed from 1
+
+    # Only grid the window around the reference pixel, and move the reference pixel into it
+    window = None
+    if crop:
+        window = crop_window(ref_pixx, ref_pixy, crop)
+        ref_pixy -= window[0]
+        ref_pixx -= window[2]
+
+    tx, ty = grid_axes(x, y, cell_size)
+    if window is not None:
+        tx, ty = tx[window[2]:window[3]], ty[window[0]:window[1]]
+    return x, y, window, ref_pixx, ref_pixy, (len(ty), len(tx))
+
+
+def beam_cubes(job):
+    """
+    Make the XX & YY cubes of one beam for the compound beam and/or antennas.
+
+    job: (beam, antennas, tasks, drop), with None in antennas for the compound beam, the indices of the tasks to
+         use (None for all tasks) and a dict with the indices of the tasks that are left out for an antenna
+         (see modules.drift_qc)
+    returns: (beam, [(antenna, cubes), ...], report), with cubes = (cube_xx, cube_yy, ref_pixx, ref_pixy) with
+             the cubes normalised to the peak of the beam and the reference pixel of the calibrator (FITS
+             indexed from 1). For an antenna without data cubes is None. report is a list with the
+             residuals against the cubic backend per antenna and polarisation (empty if not asked for).
+    """
+    beam, antennas, tasks, drop = job
+
+    offsets = select_tasks(_shared['offsets'], tasks)
+    x, y, window, ref_pixx, ref_pixy, shape = beam_geometry(offsets, beam, _shared['calib_dec'], _shared['cell_size'],
+                                                            _shared['crop'])
+    counts = [len(x_task[beam]) for x_task, y_task in offsets]
+    values, found = beam_samples(beam, antennas, counts, tasks, drop)
+    if not found:
+        return beam, [(ant, None) for ant in antennas], []
+
+    # The antennas with the same tasks left out share the samples, so they are gridded together. Without any
+    # left out tasks all frequency bins, both polarisations and all antennas are interpolated at once, with a
+    # single setup of the gridder (e.g. one triangulation) for the sample positions of this beam. All maps
+    # are on the grid of the beam.
+    sample_tasks = np.repeat(np.arange(len(_shared['offsets'])) if tasks is None else tasks, counts)
+    groups = {}
+    for i, ant in enumerate(found):
+        groups.setdefault(tuple(sorted(drop.get(ant, ()))), []).append(i)
+    axes = grid_axes(x, y, _shared['cell_size'])
+
+    cubes = {}
+    reference = {}
+    grid_time = reference_time = 0.
+    for left_out, rows in groups.items():
+        if left_out:
+            use = ~np.isin(sample_tasks, left_out)
+            group_x, group_y, group_values = x[use], y[use], values[rows][..., use]
+        else:
+            group_x, group_y, group_values = x, y, values if len(rows) == len(found) else values[rows]
+
+        start = time.time()
+        gridcubs = gridders[_shared['gridder']](group_x, group_y, _shared['cell_size'], window=window,
+                                                axes=axes).interpolate(group_values)
+        grid_time += time.time() - start
+        cubes.update((found[i], normalise(gridcubs[j, 0], gridcubs[j, 1], ref_pixx, ref_pixy) + (ref_pixx, ref_pixy))
+                     for j, i in enumerate(rows))
+
+        if _shared['report'] and _shared['gridder'] != 'cubic':
+            start = time.time()
+            refcubs = CubicGridder(group_x, group_y, _shared['cell_size'], window=window,
+                                   axes=axes).interpolate(group_values)
+            reference_time += time.time() - start
+            reference.update((found[i], normalise(refcubs[j, 0], refcubs[j, 1], ref_pixx, ref_pixy))
+                             for j, i in enumerate(rows))
+
+    report = []
+    if _shared['report']:
+        if _shared['gridder'] == 'cubic':
+            reference, reference_time = cubes, grid_time
+        for ant in found:
+            for p, pol in enumerate(['xx', 'yy']):
+                row = {'beam': beam, 'antenna': 'CB' if ant is None else ant, 'pol': pol,
+                       'time': grid_time, 'time_cubic': reference_time}
+                row.update(residuals(cubes[ant][p], reference[ant][p]))
+                report.append(row)
+
+    return beam, [(ant, cubes.get(ant)) for ant in antennas], report
+
+
+def select_tasks(task_list, tasks=None):
+    """
+    The items of a per task list (data_tab or offsets) of the task indices, all items for None.
+    """
+    if tasks is None:
+        return task_list
+    return [task_list[t] for t in tasks]
+
+
+def beam_samples(beam, antennas, counts, tasks=None, drop=None):
+    """
+    The samples of one beam of all tasks, in one contiguous array.
+
+    counts: number of samples of the beam in every task
+    tasks: indices of the tasks to use, None for all tasks
+    drop: dict with the indices of the tasks that are left out for an antenna, their samples can be NaN
+    returns: values: median subtracted samples, shape (antenna, 2 (xx, yy), freqchunks, samples)
+             found: the antennas in values, antennas without data in one of their tasks (or tasks without
+                    data for the beam) are left out
+    """
+    drop = drop or {}
+    task_ids = range(len(_shared['data_tab'])) if tasks is None else tasks
+    blocks = [task_block(data, beam, _shared['freqchunks'], antennas)
+              for data in select_tasks(_shared['data_tab'], tasks)]
+    found = [ant for ant in antennas
+             if all(ant in task_found or t in drop.get(ant, ()) for t, (block, task_found) in zip(task_ids, blocks))]
+    if not found:
+        return None, found
+
+    values = np.full((len(found), 2, _shared['freqchunks'], sum(counts)), np.nan)
+    start = 0
+    for count, (block, task_found) in zip(counts, blocks):
+        rows = [i for i, ant in enumerate(found) if ant in task_found]
+        if rows:
+            block = block[[task_found.index(found[i]) for i in rows]]
+            # One median per series, for all antennas, polarisations and frequency bins of the task at once
+            values[rows, ..., start:start + count] = block - np.median(block, axis=-1, keepdims=True)
+        start += count
+
+    return values, found
+
+
+def normalise(gridcubx, gridcuby, ref_pixx, ref_pixy):
+    """
+    Normalise every frequency bin of the XX & YY cubes to the peak of the primary beam, taken within
+    3 pixels of the reference pixel.
+    """
+    cube_xx = np.zeros(gridcubx.shape)
+    cube_yy = np.zeros(gridcuby.shape)
+    for f in range(gridcubx.shape[0]):
+        norm_xx = np.max(gridcubx[f, int(ref_pixy) - 3:int(ref_pixy) + 4, int(ref_pixx) - 3:int(ref_pixx) + 4])
+        norm_yy = np.max(gridcuby[f, int(ref_pixy) - 3:int(ref_pixy) + 4, int(ref_pixx) - 3:int(ref_pixx) + 4])
+
+        cube_xx[f, :, :] = gridcubx[f]/norm_xx
+        cube_yy[f, :, :] = gridcuby[f]/norm_yy
+
+    return cube_xx, cube_yy
@@ -1,15 +1,15 @@
-from astropy.coordinates import SkyCoord
+from modules.catalogue import get_calibrator
 
 # Standard calibrators:
 # names = ['3C138', '3C147', 'CTD93', '3C286', '3C48']
 cb_names = ['Cyg A']
-cb_cal = [SkyCoord.from_name(name) for name in cb_names]
+cb_cal = [get_calibrator(name) for name in cb_names]
 flux_names = ['3C147', '3C196']
-flux_cal = [SkyCoord.from_name(name) for name in flux_names]
+flux_cal = [get_calibrator(name) for name in flux_names]
 pol_names = ['3C138', '3C286', 'CTD93', '3C48']
-pol_cal = [SkyCoord.from_name(name) for name in pol_names]
+pol_cal = [get_calibrator(name) for name in pol_names]
 psr_names = ['B1933+16', 'B0531+21', 'B0329+54', 'B0950+08']
-psr_cal = [SkyCoord.from_name('PSR '+name) for name in psr_names]
+psr_cal = [get_calibrator('PSR '+name) for name in psr_names]
 
 if __name__ == '__main__':
     print("Drift scan calibrators are:")
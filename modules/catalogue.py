@@ -0,0 +1,133 @@
+"""
+Offline positions of the calibrators.
+
+Positions come from the bundled catalogue (calibrator_catalogue.csv) and from an on-disk cache
+(~/.cache/aperpb/calibrators.json, or $APERPB_CACHE_DIR). Sources that are in neither are only
+resolved over the network (SkyCoord.from_name) if this is asked for explicitly, and the result is
+added to the cache. The apparent (precessed) positions on the date of a task are cached as well.
+"""
+
+import json
+import os
+
+from astropy.coordinates import SkyCoord, FK5
+from astropy.time import Time
+import astropy.units as u
+
+catalogue_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibrator_catalogue.csv')
+
+_catalogue = None
+_cache = None
+
+
+def normalise(name):
+    return name.replace(' ', '').lower()
+
+
+def load_catalogue():
+    """
+    The bundled catalogue as a dict of normalised name (and aliases) -> (name, ra, dec) in degrees.
+    """
+    global _catalogue
+
+    if _catalogue is None:
+        _catalogue = {}
+        with open(catalogue_file) as f:
+            lines = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        for line in lines[1:]:
+            name, aliases, ra, dec = line.split(',')
+            coord = SkyCoord(ra, dec, frame='icrs')
+            entry = (name, coord.ra.deg, coord.dec.deg)
+            for key in [name] + aliases.split(';'):
+                if key:
+                    _catalogue[normalise(key)] = entry
+    return _catalogue
+
+
+def cache_file():
+    cache_dir = os.environ.get('APERPB_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'aperpb'))
+    return os.path.join(cache_dir, 'calibrators.json')
+
+
+def load_cache():
+    global _cache
+
+    if _cache is None:
+        _cache = {'resolved': {}, 'apparent': {}}
+        if os.path.exists(cache_file()):
+            try:
+                with open(cache_file()) as f:
+                    _cache.update(json.load(f))
+            except ValueError:
+                print('Ignoring unreadable calibrator cache {}'.format(cache_file()))
+    return _cache
+
+
+def save_cache():
+    """
+    Write the cache, via a temporary file so parallel runs never see a partial file.
+    """
+    path = cache_file()
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(load_cache(), f, indent=1)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        print('Could not write the calibrator cache: {}'.format(e))
+
+
+def get_calibrator(name, resolve=False):
+    """
+    ICRS position of a calibrator.
+
+    name: name of the source, e.g. 'Cyg A', '3C147' or 'PSR B0329+54'
+    resolve: if True, resolve sources that are not in the catalogue or the cache over the network
+    """
+    key = normalise(name)
+    entry = load_catalogue().get(key)
+    if entry is None:
+        entry = load_cache()['resolved'].get(key)
+    if entry is None:
+        if not resolve:
+            raise KeyError('{} is not in the calibrator catalogue ({}) or the cache ({}). '
+                           'Allow name resolution over the network to add it.'.format(name, catalogue_file,
+                                                                                      cache_file()))
+        coord = SkyCoord.from_name(name)
+        entry = (name, coord.ra.deg, coord.dec.deg)
+        load_cache()['resolved'][key] = entry
+        save_cache()
+
+    return SkyCoord(ra=entry[1] * u.deg, dec=entry[2] * u.deg, frame='icrs')
+
+
+def task_id2equinox(task_id):
+
+    # Automatically take the date of the observaitons from the task_id to calculate apparent coordinates of calibrator
+    year = 2000 + int(str(task_id)[0:2])
+    month = str(task_id)[2:4]
+    day = str(task_id)[4:6]
+    equinox = Time('{}-{}-{}'.format(year, month, day))
+
+    return equinox.decimalyear
+
+
+def apparent_coordinates(name, task_id, resolve=False):
+    """
+    Position of a calibrator in apparent coordinates (FK5 at the equinox of the observing date of
+    the task), because that is what the telescope observes it in. Cached per source and date.
+    """
+    calib = get_calibrator(name, resolve=resolve)
+    equinox = 'J{}'.format(task_id2equinox(task_id))
+    key = '{}|{}'.format(normalise(name), equinox)
+
+    entry = load_cache()['apparent'].get(key)
+    if entry is None or entry['icrs'] != [calib.ra.deg, calib.dec.deg]:
+        calibnow = calib.transform_to('fk5').transform_to(FK5(equinox=equinox))
+        entry = {'icrs': [calib.ra.deg, calib.dec.deg], 'ra': calibnow.ra.deg, 'dec': calibnow.dec.deg}
+        load_cache()['apparent'][key] = entry
+        save_cache()
+
+    return SkyCoord(ra=entry['ra'] * u.deg, dec=entry['dec'] * u.deg, frame=FK5(equinox=equinox))
@@ -0,0 +1,185 @@
+"""
+Consolidated store for the beam cubes of one date, instead of 4 FITS files per beam (and antenna).
+
+A store is a directory (<calibrator>_<date>_cubes/ next to the FITS files) with:
+- data.npy: float32 array with shape (beam, antenna, pol (xx, yy), freq bin, y, x). Antenna slot 0
+  is the compound beam if it was made. The maps of the beams have different sizes; every map is
+  stored in the lower left corner of the slot and the rest is NaN.
+- meta.json: beams, antennas (null for the compound beam), the size and reference pixel of the maps
+  of every beam, which antennas have data, and the WCS that all maps share.
+
+The array is memory-mapped when read and the beam is the slowest axis, so reading one beam (or one
+antenna of one beam) only reads that part of the file. The legacy FITS files can be made from a
+store with export_cube_fits.py.
+"""
+
+import json
+import os
+import shutil
+
+from astropy.wcs import WCS
+import numpy as np
+
+from modules.fits_io import write_image
+
+STORE_VERSION = 1
+pols = ['xx', 'yy']
+
+
+def cube_store_path(basedir, date, calibname):
+    return os.path.join(basedir, 'fits_files', date, '{}_{}_cubes'.format(calibname.replace(" ", ""), date))
+
+
+def fits_path(basedir, date, calibname, beam, ant=None):
+    """
+    Legacy FITS files of a beam, without the _{xx,yy,I,diff}.fits suffix.
+    """
+    calibname = calibname.replace(" ", "")
+    if ant is None:
+        return os.path.join(basedir, 'fits_files', date, '{}_{}_{:02}'.format(calibname, date, beam))
+    return os.path.join(basedir, 'fits_files', date, 'ant_{}'.format(ant),
+                        '{}_{}_{:02}_ant{}'.format(calibname, date, beam, ant))
+
+
+def beam_header(wcs_meta, ref_pixx, ref_pixy):
+    """
+    FITS header of a beam cube.
+
+    wcs_meta: dict with cell_size, cdelt & crval of the frequency axis, and ra & dec of the calibrator (ICRS)
+    ref_pixx, ref_pixy: the reference pixel of the calibrator (FITS indexed from 1)
+    """
+    ref_pixz = 1                                                # FITS indexed from 1
+
+    wcs = WCS(naxis=3)
+    wcs.wcs.cdelt = np.array([-wcs_meta['cell_size'], wcs_meta['cell_size'], wcs_meta['cdelt']])
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN', 'FREQ']
+    wcs.wcs.crval = [wcs_meta['ra'], wcs_meta['dec'], wcs_meta['crval']]
+    wcs.wcs.crpix = [ref_pixx, ref_pixy, ref_pixz]
+    wcs.wcs.specsys = 'TOPOCENT'
+    wcs.wcs.restfrq = 1.420405752e+9
+    return wcs.to_header()
+
+
+def write_fits_cubes(path, cube_xx, cube_yy, header, dtype='float64', compress=False):
+    """
+    Write the XX, YY, I and XX-YY cubes to <path>_{xx,yy,I,diff}.fits
+
+    dtype, compress: see modules.fits_io.write_image
+    """
+    stokesI = np.sqrt(0.5 * cube_yy**2 + 0.5 * cube_xx**2)
+    squint = cube_xx - cube_yy
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    for cube, pol in zip([cube_xx, cube_yy, stokesI, squint], ['xx', 'yy', 'I', 'diff']):
+        write_image('{}_{}.fits'.format(path, pol), cube, header, dtype=dtype, compress=compress)
+
+
+class CubeStoreWriter(object):
+    """
+    Write a store beam by beam. The store is written to a temporary directory and moved into place by
+    close(), so a store either exists completely or not at all.
+
+    path: directory of the store
+    beams: list of the beams
+    antennas: list of the antennas, None for the compound beam
+    freqchunks: number of frequency bins
+    shapes: dict with the (y, x) size of the maps of every beam
+    wcs_meta: see beam_header
+    meta: extra keywords to record in meta.json (e.g. calibrator, date, frequency setup)
+    """
+
+    def __init__(self, path, beams, antennas, freqchunks, shapes, wcs_meta, **meta):
+        self.path = path
+        self.tmp_path = path.rstrip('/') + '.tmp'
+        self.beams = list(beams)
+        self.antennas = list(antennas)
+        self.shapes = dict((beam, tuple(int(n) for n in shapes[beam])) for beam in self.beams)
+
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        ny = max(shape[0] for shape in self.shapes.values())
+        nx = max(shape[1] for shape in self.shapes.values())
+        self.data = np.lib.format.open_memmap(os.path.join(self.tmp_path, 'data.npy'), mode='w+', dtype=np.float32,
+                                              shape=(len(self.beams), len(self.antennas), len(pols), freqchunks, ny, nx))
+        self.data[:] = np.nan
+
+        self.meta = meta
+        self.meta.update({'version': STORE_VERSION, 'beams': [int(b) for b in self.beams],
+                          'antennas': [None if a is None else int(a) for a in self.antennas], 'pols': pols,
+                          'wcs': wcs_meta, 'shapes': {}, 'crpix': {}, 'has_data': {}})
+
+    def add(self, beam, ant, cube_xx, cube_yy, ref_pixx, ref_pixy):
+        b = self.beams.index(beam)
+        a = self.antennas.index(ant)
+        ny, nx = self.shapes[beam]
+        self.data[b, a, 0, :, :ny, :nx] = cube_xx
+        self.data[b, a, 1, :, :ny, :nx] = cube_yy
+
+        self.meta['shapes'][str(beam)] = [ny, nx]
+        self.meta['crpix'][str(beam)] = [ref_pixx, ref_pixy]
+        self.meta['has_data'].setdefault(str(beam), []).append(None if ant is None else int(ant))
+
+    def close(self):
+        self.data.flush()
+        del self.data
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+class CubeStore(object):
+    """
+    Read access to a store. The array is memory-mapped, nothing is read until it is sliced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.beams = self.meta['beams']
+        self.antennas = self.meta['antennas']
+        self.data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+
+    def has_data(self, beam, ant=None):
+        return ant in self.meta['has_data'].get(str(beam), [])
+
+    def cubes(self, beam, ant=None):
+        """
+        The XX & YY cubes of one beam of the compound beam (None) or an antenna, shape (freq bin, y, x).
+        Raises a KeyError if they are not in the store.
+        """
+        if not self.has_data(beam, ant):
+            raise KeyError('No cubes for beam {} and antenna {} in {}'.format(beam, ant, self.path))
+        ny, nx = self.meta['shapes'][str(beam)]
+        cubes = self.data[self.beams.index(beam), self.antennas.index(ant), :, :, :ny, :nx]
+        return cubes[0], cubes[1]
+
+    def crpix(self, beam):
+        return self.meta['crpix'][str(beam)]
+
+    def header(self, beam):
+        """
+        FITS header of the cubes of a beam, the same for the compound beam and all antennas.
+        """
+        return beam_header(self.meta['wcs'], *self.crpix(beam))
+
+    def export_fits(self, basedir, beams=None, date=None, calibname=None, dtype='float32', compress=False):
+        """
+        Write the legacy FITS files (xx, yy, I & diff) of the beams (default all) and antennas in the store.
+
+        dtype, compress: see modules.fits_io.write_image
+        """
+        date = self.meta['date'] if date is None else date
+        calibname = self.meta['calibname'] if calibname is None else calibname
+        for beam in self.beams if beams is None else beams:
+            for ant in self.antennas:
+                if self.has_data(beam, ant):
+                    cube_xx, cube_yy = self.cubes(beam, ant)
+                    write_fits_cubes(fits_path(basedir, date, calibname, beam, ant), np.asarray(cube_xx),
+                                     np.asarray(cube_yy), self.header(beam), dtype=dtype, compress=compress)
@@ -0,0 +1,75 @@
+"""
+Coordinates of the drift scan samples relative to the calibrator.
+
+The offsets only depend on the task and the beam, so they are computed once per task for all
+40 beams in one vectorised step (one apparent sidereal time calculation per task) and cached on
+disk next to the extracted data. The compound and the per antenna map makers share the cache.
+"""
+
+import os
+
+from astropy.time import Time
+import numpy as np
+
+from modules.telescope_params import westerbork
+
+
+def wrap_180(angle):
+    """
+    Wrap angles in degrees to [-180, 180), like Angle.wrap_at('180d').
+    """
+    return angle - 360. * np.floor((angle + 180.) / 360.)
+
+
+def drift_offsets(times, ha, dec, calibnow):
+    """
+    Offsets of the drift scan samples of all beams of one task from the calibrator.
+
+    times: time of the samples in seconds (MJD * 86400), shape (time)
+    ha, dec: HA & Dec of the beam centres in radians, shape (beam)
+    calibnow: the calibrator in apparent coordinates (see modules.catalogue.apparent_coordinates)
+    returns: x, the physical HA offsets in degrees with shape (beam, time), and
+             y, the declination of the beams in degrees with shape (beam)
+    """
+    time_mjd = Time(np.asarray(times) / (3600 * 24), format='mjd')
+    time_mjd.delta_ut1_utc = 0  # extra line to compensate for missing icrs tables
+    lst = time_mjd.sidereal_time('apparent', westerbork().lon)
+
+    HAcal = lst.deg - calibnow.ra.deg  # in sky coords
+    dHAsky = wrap_180(HAcal[np.newaxis, :] - np.degrees(np.asarray(ha))[:, np.newaxis] + 360.)  # in sky coords
+    y = np.degrees(np.asarray(dec))
+    x = dHAsky * np.cos(np.radians(y))[:, np.newaxis]  # physical offset
+
+    return x, y
+
+
+def offsets_file(basedir, task_id):
+    return os.path.join(basedir, str(task_id), '{}_drift_offsets.npz'.format(task_id))
+
+
+def task_offsets(basedir, task_id, data, hadec, calibnow):
+    """
+    drift_offsets of a task, read from the cache file if it was made for the same time axis,
+    beam positions and calibrator position, and computed and cached otherwise.
+
+    data: the extracted data of the task (DriftStore or table with a 'time' column)
+    hadec: the beam positions with 'ha' and 'dec' columns in radians
+    """
+    times = np.asarray(data['time'], dtype=np.float64)
+    ha = np.asarray(hadec['ha'], dtype=np.float64)
+    dec = np.asarray(hadec['dec'], dtype=np.float64)
+    key = np.concatenate([times, ha, dec, [calibnow.ra.deg, calibnow.dec.deg]])
+
+    cache = offsets_file(basedir, task_id)
+    if os.path.exists(cache):
+        with np.load(cache) as cached:
+            if cached['key'].shape == key.shape and np.array_equal(cached['key'], key):
+                return cached['x'], cached['y']
+
+    x, y = drift_offsets(times, ha, dec, calibnow)
+    try:
+        np.savez(cache, key=key, x=x, y=y)
+    except (IOError, OSError) as e:
+        print('Could not cache the drift offsets of {}: {}'.format(task_id, e))
+
+    return x, y
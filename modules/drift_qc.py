@@ -0,0 +1,200 @@
+"""
+Quality screen of the extracted drift scan data before gridding.
+
+The data of every task and beam is read once (all antennas, polarisations and frequency bins in one
+block) and checked at once for:
+- missing: no data for an antenna (or the compound beam) in a task
+- nan: series with NaN values (the median subtraction turns the whole series into NaN)
+- zero: series that are all zero
+- dropped: timestamps missing from the time axis of a task (gaps longer than 1.5 times the median step)
+- outlier: drifts with a noise (MAD of the sample to sample differences) far from that of the other
+  drifts of the same beam and antenna
+- no_peak: no positive signal in the samples within a few map cells of the calibrator (or the samples
+  closest to it), where the cubes are normalised (norm_xx & norm_yy in modules.beam_maps.normalise)
+- drifts: an antenna with fewer than two drifts left for a beam, which cannot be gridded
+
+The result is a work plan, the tasks, antennas and left out (antenna, task) pairs to grid for every beam,
+and a report with one row per problem. A bad series of the compound beam drops that task from the beam for
+all antennas, and defines the tasks (and so the map geometry) of the beam. A bad series of an antenna only
+drops that drift of the antenna; its map is made from its other drifts, on the grid of the beam.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from modules.drift_store import task_block
+
+report_columns = ['task', 'beam', 'antenna', 'check', 'value', 'action']
+
+
+def time_gaps(times):
+    """
+    returns: number of dropped timestamps, as fraction of the expected number, and whether the time axis increases
+    """
+    dt = np.diff(np.asarray(times, dtype=np.float64))
+    if len(dt) == 0:
+        return 0, 0., True
+    step = np.median(dt)
+    if step <= 0:
+        return 0, 0., False
+    gaps = dt > 1.5 * step
+    dropped = int(np.sum(np.rint(dt[gaps] / step) - 1))
+    return dropped, dropped / float(len(dt) + 1 + dropped), bool(np.all(dt > 0))
+
+
+def series_noise(block):
+    """
+    Robust noise of every series: the MAD of the sample to sample differences, shape block.shape[:-1].
+    """
+    diff = np.diff(block, axis=-1)
+    return 1.4826 * np.median(np.abs(diff - np.median(diff, axis=-1, keepdims=True)), axis=-1) / np.sqrt(2)
+
+
+def screen_drifts(data_tab, offsets, tasks, beams, antennas, freqchunks, calib_dec, cell_size, outlier=5.,
+                  max_dropped=0.25, peak_cells=3):
+    """
+    Screen the data of all tasks and make the work plan.
+
+    data_tab, offsets: the extracted data and the drift offsets of every task (as for modules.beam_maps.init_worker)
+    tasks: the task ids, for the report
+    antennas: the antennas to make, None for the compound beam
+    outlier: factor by which the noise of a drift may differ from the median of the drifts of the beam
+    max_dropped: leave out a task if more than this fraction of its timestamps is missing
+    peak_cells: the calibrator peak is looked for within this many cells of the calibrator, or in the samples
+                closest to the calibrator if there are none
+    returns: plan, a dict with (task indices, antennas, drop) for every beam that can be made, with drop a dict
+             with the indices of the tasks that are left out for an antenna, and the report rows
+    """
+    report = []
+    bad_tasks = set()
+    for t, data in enumerate(data_tab):
+        dropped, fraction, increasing = time_gaps(data['time'])
+        if dropped:
+            action = 'skip_task' if fraction > max_dropped else 'warn'
+            report.append((tasks[t], None, None, 'dropped', dropped, action))
+            if action == 'skip_task':
+                bad_tasks.add(t)
+        if not increasing:
+            report.append((tasks[t], None, None, 'dropped', 'time not increasing', 'warn'))
+
+    plan = {}
+    for beam in beams:
+        skip_tasks = set(bad_tasks)
+        skip_antennas = set()
+        drop = {}
+        noise = {}
+        missing = {}
+        peak = dict((ant, np.full((2, freqchunks), -np.inf)) for ant in antennas)
+
+        # Distance of the samples to the calibrator, in cells
+        distance = [np.hypot(x_task[beam], y_task[beam] - calib_dec) / cell_size for x_task, y_task in offsets]
+        radius = max(peak_cells + 0.5, 1.5 * min(np.min(d) for d in distance))
+
+        for t, data in enumerate(data_tab):
+            if t in bad_tasks:
+                continue
+            block, found = task_block(data, beam, freqchunks, antennas)
+            for ant in antennas:
+                if ant not in found:
+                    missing.setdefault(ant, []).append(t)
+                    _skip(ant, t, skip_tasks, drop)
+            if not found:
+                continue
+
+            nan = ~np.all(np.isfinite(block), axis=-1)          # shape (antenna, pol, freq bin)
+            zero = np.all(block == 0, axis=-1)
+            flagged = []
+            for i, ant in enumerate(found):
+                for check, bad in [('nan', nan[i]), ('zero', zero[i])]:
+                    if bad.any():
+                        report.append((tasks[t], beam, ant, check, int(bad.sum()), _action(ant)))
+                        _skip(ant, t, skip_tasks, drop)
+                        flagged.append(ant)
+
+            values = block - np.median(block, axis=-1, keepdims=True)
+            task_noise = series_noise(block)
+            near = distance[t] <= radius
+            for i, ant in enumerate(found):
+                if ant in flagged:
+                    continue
+                noise.setdefault(ant, {})[t] = task_noise[i]
+                if near.any():
+                    with np.errstate(invalid='ignore'):
+                        peak[ant] = np.fmax(peak[ant], np.max(values[i][..., near], axis=-1))
+
+        # An antenna without data in any task is reported once for the beam
+        for ant, missing_tasks in missing.items():
+            if len(missing_tasks) == len(data_tab) - len(bad_tasks):
+                report.append((None, beam, ant, 'missing', len(missing_tasks),
+                               'skip_task' if ant is None else 'skip_antenna'))
+                if ant is not None:
+                    skip_antennas.add(ant)
+            else:
+                report.extend((tasks[t], beam, ant, 'missing', 1, _action(ant)) for t in missing_tasks)
+
+        # Drifts with a noise far from that of the other drifts of the beam
+        for ant, task_noise in noise.items():
+            drifts = sorted(task_noise)
+            levels = np.array([task_noise[t] for t in drifts])          # shape (task, pol, freq bin)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ratio = levels / np.nanmedian(levels, axis=0)
+            for t, r in zip(drifts, ratio):
+                if np.any((r > outlier) | (r < 1. / outlier)):
+                    report.append((tasks[t], beam, ant, 'outlier', round(float(np.nanmax(np.maximum(r, 1. / r))), 2),
+                                   _action(ant)))
+                    _skip(ant, t, skip_tasks, drop)
+
+        for ant in antennas:
+            if ant in skip_antennas or ant not in noise:
+                continue
+            if not np.all(np.isfinite(peak[ant]) & (peak[ant] > 0)):
+                report.append((None, beam, ant, 'no_peak', '', 'skip_antenna'))
+                skip_antennas.add(ant)
+
+        # The drifts left out of an antenna, and antennas with too few drifts left
+        use_tasks = [t for t in range(len(data_tab)) if t not in skip_tasks]
+        drop = dict((ant, [t for t in use_tasks if t in drop[ant]]) for ant in drop)
+        for ant, tasks_out in drop.items():
+            left = len(use_tasks) - len(tasks_out)
+            if tasks_out and left < 2 and ant not in skip_antennas:
+                report.append((None, beam, ant, 'drifts', left, 'skip_antenna'))
+                skip_antennas.add(ant)
+        use_antennas = [ant for ant in antennas if ant not in skip_antennas]
+        if use_tasks and use_antennas:
+            plan[beam] = (use_tasks, use_antennas, dict((ant, drop[ant]) for ant in use_antennas if drop.get(ant)))
+
+    return plan, report
+
+
+def _action(ant):
+    return 'skip_task' if ant is None else 'skip_drift'
+
+
+def _skip(ant, t, skip_tasks, drop):
+    if ant is None:
+        skip_tasks.add(t)
+    else:
+        drop.setdefault(ant, set()).add(t)
+
+
+def write_qc_report(path, report, plan, beams, antennas):
+    """
+    Write the report rows to a csv file, and print a summary of the work plan.
+    """
+    # The antenna is None for the compound beam, the beam (and antenna) for the problems of a whole task
+    rows = [(task, '' if beam is None else beam, '' if beam is None else 'CB' if ant is None else ant, check, value,
+             action) for task, beam, ant, check, value, action in report]
+    report = pd.DataFrame(rows, columns=report_columns, dtype=object)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    report.to_csv(path, index=False)
+
+    for check, rows in report.groupby('check'):
+        print("QC {}: {} problems".format(check, len(rows)))
+    skipped = [beam for beam in beams if beam not in plan]
+    pruned = sum(len(antennas) - len(plan[beam][1]) for beam in plan)
+    dropped = sum(len(tasks) for beam in plan for tasks in plan[beam][2].values())
+    print("QC: {} beams left out, {} beam maps of antennas left out, {} drifts of antennas left out. Report "
+          "written to {}".format(len(skipped), pruned, dropped, path))
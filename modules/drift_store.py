@@ -0,0 +1,287 @@
+"""
+Binary store for the auto correlation data extracted from the drift scans.
+
+A store is a directory per task with:
+- data.npy: float32 array with shape (beam, antenna, freq bin, pol, time). Antenna slot 0 is the
+  compound beam (average of all antennas), slot n + 1 is antennas[n].
+- time.npy: the time axis in seconds (MJD * 86400, as in the MS)
+- hadec.npy: HA & Dec of the beam centres in radians, shape (beam, 2)
+- meta.json: beams, antennas, polarisations and the extraction settings
+
+The arrays are memory-mapped when read, so a single beam or antenna can be sliced out without
+reading the rest. DriftStore also answers to the column names of the old
+_exported_data_frequency_split.csv files, so it can be used in place of the csv table.
+"""
+
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+STORE_VERSION = 1
+
+column_pattern = re.compile(r'^auto_corr_beam_(\d+)_freq_(\d+)_([xy]{2})(?:_antenna_(\d+))?$')
+
+
+def store_path(data_location, task_id):
+    """
+    Location of the store of a task, next to the csv files.
+    """
+    return os.path.join(data_location, str(task_id), '{}_drift_store'.format(task_id))
+
+
+def write_store(path, times, hadec, data, beams, antennas, pols, **meta):
+    """
+    Write a store in one go. The store is first written to a temporary directory and then moved
+    into place, so a store either exists completely or not at all.
+
+    path: directory of the store
+    times: time axis, shape (time)
+    hadec: HA & Dec of the beam centres in radians, shape (beam, 2)
+    data: auto correlation data, shape (beam, 1 + antenna, freq bin, pol, time)
+    beams: list of the beam numbers along the first axis
+    antennas: list of the antenna numbers in slots 1..n of the second axis
+    pols: list of the polarisation names, e.g. ['xx', 'xy', 'yx', 'yy']
+    meta: extra keywords to record in meta.json (e.g. task_id, chan_range, chan_bins)
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if data.shape != (len(beams), len(antennas) + 1, data.shape[2], len(pols), len(times)):
+        raise ValueError('Data shape {} does not match the axes of the store'.format(data.shape))
+
+    tmp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    np.save(os.path.join(tmp_path, 'data.npy'), data)
+    np.save(os.path.join(tmp_path, 'time.npy'), np.asarray(times, dtype=np.float64))
+    np.save(os.path.join(tmp_path, 'hadec.npy'), np.asarray(hadec, dtype=np.float64))
+
+    meta.update({'version': STORE_VERSION, 'beams': [int(b) for b in beams],
+                 'antennas': [int(a) for a in antennas], 'pols': list(pols)})
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+class DriftStore(object):
+    """
+    Read access to a store. Arrays are memory-mapped, nothing is read until it is sliced.
+
+    store['time'] and store['auto_corr_beam_<b>_freq_<f>_<pol>[_antenna_<a>]'] return the same
+    series as the columns of the csv table. Antennas without data raise a KeyError, like a
+    column that is missing from the csv table.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.beams = self.meta['beams']
+        self.antennas = self.meta['antennas']
+        self.pols = self.meta['pols']
+        self.data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+        self.time = np.load(os.path.join(path, 'time.npy'))
+        hadec = np.load(os.path.join(path, 'hadec.npy'))
+        self.hadec = {'ha': hadec[:, 0], 'dec': hadec[:, 1]}
+
+    def beam_index(self, beam):
+        return self.beams.index(beam)
+
+    def antenna_index(self, antenna=None):
+        """
+        Slot of an antenna along the antenna axis. None is the compound beam.
+        """
+        if antenna is None:
+            return 0
+        return self.antennas.index(antenna) + 1
+
+    def beam(self, beam):
+        """
+        All data of one beam, shape (antenna, freq bin, pol, time).
+        """
+        return self.data[self.beam_index(beam)]
+
+    def antenna(self, antenna=None):
+        """
+        All data of one antenna (or the compound beam for None), shape (beam, freq bin, pol, time).
+        """
+        return self.data[:, self.antenna_index(antenna)]
+
+    def series(self, beam, freq, pol, antenna=None):
+        """
+        Time series of one beam, frequency bin and polarisation, shape (time).
+        """
+        return self.data[self.beam_index(beam), self.antenna_index(antenna), freq, self.pols.index(pol)]
+
+    def block(self, beam, freqchunks, antennas=(None,), pols=('xx', 'yy')):
+        """
+        The data of one beam for several antennas in one read, see beam_block.
+        """
+        try:
+            index = self.beam_index(beam)
+            pol_index = [self.pols.index(pol) for pol in pols]
+        except ValueError:
+            raise KeyError('No data for beam {} and polarisations {}'.format(beam, pols))
+        if freqchunks > self.data.shape[2]:
+            raise KeyError('{} frequency bins asked, the store has {}'.format(freqchunks, self.data.shape[2]))
+
+        found = [a for a in antennas if a is None or a in self.antennas]
+        block = self.data[index][[self.antenna_index(a) for a in found]][:, :freqchunks][:, :, pol_index]
+        block = np.swapaxes(block, 1, 2)  # (antenna, pol, freq bin, time)
+
+        # Antennas without data (all NaN) are not in the csv table either
+        keep = [i for i, a in enumerate(found) if a is None or not np.all(np.isnan(block[i]))]
+        return block[keep], [found[i] for i in keep]
+
+    def has_data(self, beam, antenna=None):
+        """
+        False if there is no data for an antenna in a beam (all NaN), these are not in the csv table.
+        """
+        return not np.all(np.isnan(self.data[self.beam_index(beam), self.antenna_index(antenna)]))
+
+    def columns(self):
+        """
+        Names of the columns of the equivalent csv table.
+        """
+        names = ['time']
+        for beam in self.beams:
+            for a in [None] + self.antennas:
+                if a is not None and not self.has_data(beam, a):
+                    continue
+                for freq in range(self.data.shape[2]):
+                    for pol in self.pols:
+                        names.append(column_name(beam, freq, pol, a))
+        return names
+
+    def __getitem__(self, name):
+        if name == 'time':
+            return self.time
+        match = column_pattern.match(name)
+        if match is None:
+            raise KeyError(name)
+        beam, freq, pol, antenna = match.groups()
+        antenna = None if antenna is None else int(antenna)
+        try:
+            series = self.series(int(beam), int(freq), pol, antenna)
+        except (ValueError, IndexError):
+            raise KeyError(name)
+        if antenna is not None and not self.has_data(int(beam), antenna):
+            raise KeyError(name)
+        return series
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def to_dataframe(self):
+        """
+        The store as a pandas data frame with the columns of the csv table.
+        """
+        import pandas as pd
+
+        return pd.DataFrame({name: np.asarray(self[name]) for name in self.columns()})
+
+
+def column_name(beam, freq, pol, antenna=None):
+    """
+    Column name of a series in the csv table.
+    """
+    name = 'auto_corr_beam_{}_freq_{}_{}'.format(beam, freq, pol)
+    if antenna is not None:
+        name += '_antenna_{}'.format(antenna)
+    return name
+
+
+def beam_block(data, beam, freqchunks, antennas=(None,), pols=('xx', 'yy')):
+    """
+    The data of one beam of a task for several antennas (None for the compound beam) at once.
+
+    data: a DriftStore or the csv table of a task
+    returns: block with shape (antenna, pol, freq bin, time) and the list of antennas that have data,
+             antennas without data are left out. Raises a KeyError if there is no compound beam data.
+    """
+    if isinstance(data, DriftStore):
+        block, found = data.block(beam, freqchunks, antennas, pols)
+    else:
+        block, found = [], []
+        for a in antennas:
+            try:
+                block.append([[np.asarray(data[column_name(beam, f, pol, a)]) for f in range(freqchunks)]
+                              for pol in pols])
+                found.append(a)
+            except KeyError:
+                if a is None:
+                    raise
+        block = np.array(block)
+    if None in antennas and None not in found:
+        raise KeyError('No compound beam data for beam {}'.format(beam))
+    return block, found
+
+
+def task_block(data, beam, freqchunks, antennas=(None,), pols=('xx', 'yy')):
+    """
+    beam_block without the KeyError: the antennas that have data when the compound beam is missing,
+    and (None, []) when there is no data for the beam at all.
+    """
+    try:
+        return beam_block(data, beam, freqchunks, antennas, pols)
+    except KeyError:
+        try:
+            return beam_block(data, beam, freqchunks, [ant for ant in antennas if ant is not None], pols)
+        except KeyError:
+            return None, []
+
+
+def csv_to_store(data_file, hadec_file, path, **meta):
+    """
+    Convert an existing _exported_data_frequency_split.csv and _hadec.csv pair into a store.
+    Series that are not in the csv file (e.g. antennas without data) are NaN in the store.
+    """
+    import pandas as pd
+
+    df = pd.read_csv(data_file)
+    hadec = pd.read_csv(hadec_file)
+
+    keys = [column_pattern.match(name) for name in df.columns]
+    keys = [m.groups() for m in keys if m is not None]
+    beams = sorted(set(int(k[0]) for k in keys))
+    freqs = sorted(set(int(k[1]) for k in keys))
+    antennas = sorted(set(int(k[3]) for k in keys if k[3] is not None))
+    pols = [p for p in ['xx', 'xy', 'yx', 'yy'] if p in set(k[2] for k in keys)]
+
+    data = np.full((len(beams), len(antennas) + 1, len(freqs), len(pols), len(df)), np.nan, dtype=np.float32)
+    for beam, freq, pol, antenna in keys:
+        a = 0 if antenna is None else antennas.index(int(antenna)) + 1
+        data[beams.index(int(beam)), a, freqs.index(int(freq)), pols.index(pol)] = df[
+            column_name(beam, freq, pol, antenna)]
+
+    write_store(path, df['time'], np.column_stack([hadec['ha'], hadec['dec']]), data, beams, antennas, pols,
+                **meta)
+
+
+def read_drift_data(basedir, task_id):
+    """
+    Read the extracted data and beam positions of one task. The binary store is used if it
+    exists, otherwise the csv files are read.
+
+    returns: data (DriftStore or astropy Table), hadec (dict or astropy Table) with 'ha' and 'dec'
+    """
+    path = store_path(basedir, task_id)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        store = DriftStore(path)
+        return store, store.hadec
+
+    from astropy.table import Table
+
+    data = Table.read('{}{}/{}_exported_data_frequency_split.csv'.format(basedir, task_id, task_id), format='csv')
+    hadec = Table.read('{}{}/{}_hadec.csv'.format(basedir, task_id, task_id), format='csv')
+    return data, hadec
@@ -0,0 +1,125 @@
+"""
+Manifest of the extraction of one drift scan task, used to resume an interrupted extraction.
+
+The manifest is a json file next to the extracted data. It records the extraction settings and,
+for every beam, the fingerprint of the MS it was read from (path and size of its files),
+the antennas and frequency bins that were extracted and the file with the intermediate result.
+A rerun with the same settings only reads the beams that are missing or whose MS has changed.
+Once the task is finished the manifest lists the output files and the whole task can be skipped.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+MANIFEST_VERSION = 1
+
+
+fingerprint_keys = ['ms', 'size']
+
+
+def ms_fingerprint(ms_name):
+    """
+    Path and total size in bytes of the files of an MS. Returns None if the MS does not exist.
+    The modification times are left out: copying the same MS from the archive again (iget -f)
+    rewrites the files, but does not change the data.
+    """
+    if not os.path.isdir(ms_name):
+        return None
+    size = 0
+    for root, dirs, files in os.walk(ms_name):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return {'ms': os.path.abspath(ms_name), 'size': size}
+
+
+def manifest_path(data_location, task_id):
+    return os.path.join(data_location, str(task_id), '{}_manifest.json'.format(task_id))
+
+
+class ExtractionManifest(object):
+    """
+    Manifest of one task. The settings (e.g. chan_range, bin_num, exclude) must be json
+    serialisable. If they differ from the settings in an existing manifest, all recorded work
+    is discarded.
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.partial_dir = path.replace('_manifest.json', '_partial')
+        self.settings = json.loads(json.dumps(settings))
+        self.beams = {}
+        self.outputs = []
+
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION and manifest['settings'] == self.settings:
+                self.beams = manifest['beams']
+                self.outputs = manifest['outputs']
+            else:
+                print('Extraction settings changed, ignoring {}'.format(path))
+
+    def save(self):
+        """
+        Write the manifest. A temporary file is renamed into place, so an interrupted write
+        never leaves a broken manifest behind.
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'settings': self.settings, 'beams': self.beams,
+                       'outputs': self.outputs}, f, indent=1)
+        os.rename(tmp_path, self.path)
+
+    def complete(self):
+        """
+        True if the task was finished with these settings and all its output files still exist.
+        """
+        return len(self.outputs) > 0 and all(os.path.exists(output) for output in self.outputs)
+
+    def beam_done(self, beam, ms_name):
+        """
+        True if the beam was extracted before from the same MS. If the MS has been removed since,
+        the intermediate result is still used.
+        """
+        entry = self.beams.get(str(beam))
+        if entry is None or not os.path.exists(entry['file']):
+            return False
+        fingerprint = ms_fingerprint(ms_name)
+        # Manifests of earlier versions also recorded the modification time, which is not compared
+        return fingerprint is None or all(fingerprint[key] == entry['fingerprint'].get(key) for key in fingerprint_keys)
+
+    def load_beam(self, beam):
+        """
+        Intermediate result of a beam, in the form returned by read_auto_corr.
+        """
+        with np.load(self.beams[str(beam)]['file']) as result:
+            return result['times'], result['ant_ids'], result['auto_corr_ant'], result['auto_corr']
+
+    def save_beam(self, beam, ms_name, result):
+        """
+        Store the intermediate result of a beam (the output of read_auto_corr) and record it.
+        """
+        times, ant_ids, auto_corr_ant, auto_corr = result
+        if not os.path.exists(self.partial_dir):
+            os.makedirs(self.partial_dir)
+        file_name = os.path.join(self.partial_dir, 'beam_{:02}.npz'.format(beam))
+        np.savez(file_name + '.tmp.npz', times=times, ant_ids=ant_ids, auto_corr_ant=auto_corr_ant,
+                 auto_corr=auto_corr)
+        os.rename(file_name + '.tmp.npz', file_name)
+
+        self.beams[str(beam)] = {'fingerprint': ms_fingerprint(ms_name), 'file': file_name,
+                                 'antennas': [int(a) for a in ant_ids], 'freq_bins': int(auto_corr.shape[1]),
+                                 'time_steps': int(len(times))}
+        self.save()
+
+    def finish(self, outputs):
+        """
+        Record the output files of the task and remove the intermediate results.
+        """
+        self.outputs = [os.path.abspath(output) for output in outputs]
+        self.save()
+        if os.path.exists(self.partial_dir):
+            shutil.rmtree(self.partial_dir)
@@ -0,0 +1,39 @@
+"""
+Writing and reading the FITS images (beam cubes and beam models).
+
+Images can be written in float32 instead of float64, and as a tile compressed image. Compression is
+lossless (GZIP_2, no quantisation), and the large NaN borders of the beam maps compress very well.
+A compressed image is stored in the first extension after an empty primary HDU, as the FITS standard
+requires, so readers should use image_hdu (or fits.getdata) instead of hdu[0].
+"""
+
+from astropy.io import fits
+import numpy as np
+
+dtypes = {'float64': np.float64, 'float32': np.float32}
+
+
+def write_image(path, data, header, dtype='float64', compress=False):
+    """
+    path: output file, overwritten if it exists
+    data, header: image and its header (the WCS is taken over unchanged)
+    dtype: 'float64' or 'float32'
+    compress: write a lossless tile compressed image
+    """
+    data = np.asarray(data, dtype=dtypes[dtype])
+    if compress:
+        hdul = fits.HDUList([fits.PrimaryHDU(),
+                             fits.CompImageHDU(data, header=header, compression_type='GZIP_2', quantize_level=0)])
+    else:
+        hdul = fits.HDUList([fits.PrimaryHDU(data, header=header)])
+    hdul.writeto(path, overwrite=True)
+
+
+def image_hdu(hdul):
+    """
+    The HDU with the image of an opened file: the primary HDU, or the compressed image extension.
+    """
+    for hdu in hdul:
+        if hdu.header.get('NAXIS', 0) > 0:
+            return hdu
+    return hdul[0]
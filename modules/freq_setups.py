@@ -0,0 +1,39 @@
+"""
+Frequency setups of the Apertif drift scans.
+
+The extraction bins the 24576 channels of an observation into frequency bins (see
+drift_scan_auto_corr_frequency.py). A setup describes how the bins map onto frequency, which is
+all that differs between the beam maps of the old and the new observations.
+"""
+
+from collections import namedtuple
+
+n_channels = 24576
+channel_width = 12.207e3
+
+FreqSetup = namedtuple('FreqSetup', ['name', 'description', 'centre', 'bin_channels', 'ref_channel', 'bin_num'])
+
+freq_setups = {
+    # centre: centre frequency of the observation in Hz
+    # bin_channels: number of channels in 1 bin
+    # ref_channel: channel at the centre of the first bin
+    # bin_num: default number of bins
+    'old': FreqSetup('old', 'centered at 1280 MHz, 1050 channels in 1 bin', 1280e6, 1050, 14000, 10),
+    'new': FreqSetup('new', 'centered at 1370 MHz, 1000 channels in 1 bin', 1370e6, 1000, 6500, 18),
+}
+
+
+def get_setup(name):
+    try:
+        return freq_setups[name]
+    except KeyError:
+        raise KeyError('Unknown frequency setup {}, use one of: {}'.format(name, ', '.join(sorted(freq_setups))))
+
+
+def spectral_axis(setup):
+    """
+    cdelt & crval of the frequency axis of the beam cubes in Hz.
+    """
+    cdelt = channel_width * setup.bin_channels
+    crval = setup.centre + (channel_width * (-(n_channels / 2 - setup.ref_channel)))
+    return cdelt, crval
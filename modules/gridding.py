@@ -0,0 +1,213 @@
+"""
+Gridding of the drift scan samples of a beam onto a regular map.
+
+The sample positions of a beam are the same for all frequency bins, polarisations and antennas,
+so the setup of a gridder (e.g. the Delaunay triangulation and the lookup of the grid points in it)
+is done once per beam and all value vectors are interpolated in one batched call.
+
+Backends:
+- cubic: the same as interpolate.griddata(..., method='cubic') for every vector separately (the reference)
+- linear: the same as interpolate.griddata(..., method='linear'), on the same triangulation
+- binning: no triangulation; the samples of every drift are averaged in the cells along the drift,
+  and the map is interpolated linearly along and between the drifts
+
+Only a window of the grid can be interpolated, e.g. the region around the calibrator that is used
+by the spline fitting; the cells outside it are never looked up in the triangulation.
+"""
+
+import abc
+
+import numpy as np
+from scipy.interpolate import CloughTocher2DInterpolator, LinearNDInterpolator
+from scipy.spatial import Delaunay
+
+
+def grid_axes(x, y, cell_size):
+    """
+    The cell positions (tx, ty) of the grid with cells of cell_size degrees that covers min(x)..max(x) and
+    min(y)..max(y).
+    """
+    return np.arange(min(x), max(x), cell_size), np.arange(min(y), max(y), cell_size)
+
+
+class Gridder(abc.ABC):
+    """
+    Interpolation of the samples of one beam onto a grid with cells of cell_size degrees, covering
+    min(x)..max(x) and min(y)..max(y). The backends implement _interpolate.
+
+    x, y: positions of the samples in degrees, shape (samples)
+    cell_size: size of the grid cells in degrees
+    window: (row0, row1, col0, col1), only grid the cells [row0:row1, col0:col1] of the full grid
+    axes: (tx, ty) of the full grid instead of the grid that covers x, y, e.g. the grid of all samples of
+          the beam when only part of them is gridded
+    """
+
+    def __init__(self, x, y, cell_size, window=None, axes=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.cell_size = cell_size
+        self.tx, self.ty = grid_axes(self.x, self.y, cell_size) if axes is None else axes
+        self.full_shape = (len(self.ty), len(self.tx))
+        if window is not None:
+            row0, row1, col0, col1 = window
+            self.tx = self.tx[col0:col1]
+            self.ty = self.ty[row0:row1]
+        self.shape = (len(self.ty), len(self.tx))
+
+    def interpolate(self, values):
+        """
+        Interpolate one or more value vectors at once.
+
+        values: values at the samples, shape (..., samples)
+        returns: maps with shape (..., len(ty), len(tx)), NaN where the samples do not cover the grid
+        """
+        values = np.asarray(values, dtype=np.float64)
+        batch_shape = values.shape[:-1]
+        grid = self._interpolate(values.reshape(-1, values.shape[-1]))  # shape (vectors, ty, tx)
+        return grid.reshape(batch_shape + self.shape)
+
+    @abc.abstractmethod
+    def _interpolate(self, values):
+        """
+        values: shape (vectors, samples)
+        returns: maps with shape (vectors, len(ty), len(tx))
+        """
+
+
+class CubicGridder(Gridder):
+    """
+    Cubic (Clough-Tocher) interpolation on the Delaunay triangulation of the samples.
+    """
+
+    def __init__(self, x, y, cell_size, window=None, axes=None):
+        super(CubicGridder, self).__init__(x, y, cell_size, window, axes)
+        self.tri = Delaunay(np.column_stack([self.x, self.y]))
+
+    def _interpolator(self, values):
+        return CloughTocher2DInterpolator(self.tri, values, fill_value=np.nan)
+
+    def _interpolate(self, values):
+        XI, YI = np.meshgrid(self.tx, self.ty)
+        grid = self._interpolator(values.T)((XI, YI))  # shape (ty, tx, vectors)
+        return np.moveaxis(grid, -1, 0)
+
+
+class LinearGridder(CubicGridder):
+    """
+    Linear (barycentric) interpolation on the Delaunay triangulation of the samples.
+    """
+
+    def _interpolator(self, values):
+        return LinearNDInterpolator(self.tri, values, fill_value=np.nan)
+
+
+class BinningGridder(Gridder):
+    """
+    Regular grid binning without a triangulation. The samples of a drift (all samples with the same y)
+    are averaged in the cells of the grid along the drift, the empty cells between them are interpolated
+    linearly along the drift, and the map is interpolated linearly in y between the drifts.
+    """
+
+    def __init__(self, x, y, cell_size, window=None, axes=None):
+        super(BinningGridder, self).__init__(x, y, cell_size, window, axes)
+        # The samples are binned on the columns of the full grid, so a window gives the same maps
+        full_tx = (grid_axes(self.x, self.y, cell_size) if axes is None else axes)[0]
+        self.columns = len(full_tx)
+
+        # Drifts (rows) and grid columns of the samples
+        self.drift_y, drift = np.unique(self.y, return_inverse=True)
+        col = np.rint((self.x - (full_tx[0] if self.columns else min(self.x))) / cell_size).astype(int)
+        inside = (col >= 0) & (col < self.columns)
+        cell = drift[inside] * self.columns + col[inside]
+
+        # Sort the samples by cell, so the sums of all cells are one reduceat call
+        order = np.argsort(cell, kind='stable')
+        self.samples = np.flatnonzero(inside)[order]
+        self.cells, self.starts, counts = np.unique(cell[order], return_index=True, return_counts=True)
+        self.counts = counts.astype(np.float64)
+
+        # Linear interpolation along every drift, from the cells with samples to the columns of the map
+        filled = np.zeros(len(self.drift_y) * self.columns, dtype=bool)
+        filled[self.cells] = True
+        self.along = [(np.flatnonzero(row), linear_weights(full_tx[row], self.tx))
+                      for row in filled.reshape(len(self.drift_y), self.columns)]
+
+        # Linear interpolation between the drifts
+        self.between = linear_weights(self.drift_y, self.ty)
+
+    def _interpolate(self, values):
+        vectors = values.shape[0]
+        cells = np.full((vectors, len(self.drift_y) * self.columns), np.nan)
+        if len(self.cells):
+            cells[:, self.cells] = np.add.reduceat(values[:, self.samples], self.starts, axis=1) / self.counts
+        cells = cells.reshape(vectors, len(self.drift_y), self.columns)
+
+        drifts = np.full((vectors, len(self.drift_y), len(self.tx)), np.nan)
+        for i, (filled, weights) in enumerate(self.along):
+            drifts[:, i, :] = apply_weights(cells[:, i, filled], weights)
+
+        return np.moveaxis(apply_weights(np.moveaxis(drifts, 1, -1), self.between), -1, 1)
+
+
+def linear_weights(xp, x):
+    """
+    Weights for the linear interpolation from increasing positions xp to positions x, NaN outside xp.
+
+    returns: (lo, hi, w, inside), with f(x) = (1 - w) * f(xp[lo]) + w * f(xp[hi]) where inside
+    """
+    xp = np.asarray(xp, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    lo = np.zeros(len(x), dtype=int)
+    hi = np.zeros(len(x), dtype=int)
+    w = np.zeros(len(x))
+    if len(xp) == 0:
+        return lo, hi, w, np.zeros(len(x), dtype=bool)
+    if len(xp) > 1:
+        hi = np.clip(np.searchsorted(xp, x), 1, len(xp) - 1)
+        lo = hi - 1
+        w = (x - xp[lo]) / (xp[hi] - xp[lo])
+    inside = (x >= xp[0]) & (x <= xp[-1])
+    return lo, hi, w, inside
+
+
+def apply_weights(values, weights):
+    """
+    values: shape (..., len(xp)), weights from linear_weights
+    returns: shape (..., len(x))
+    """
+    lo, hi, w, inside = weights
+    if not inside.any():
+        return np.full(values.shape[:-1] + (len(inside),), np.nan)
+    result = (1 - w) * values[..., lo] + w * values[..., hi]
+    result[..., ~inside] = np.nan
+    return result
+
+
+gridders = {'cubic': CubicGridder, 'linear': LinearGridder, 'binning': BinningGridder}
+
+
+def residuals(maps, reference, lobe=0.5):
+    """
+    Residuals of normalised maps against the normalised maps of the reference backend.
+
+    maps, reference: maps with the same shape, normalised to the peak of the beam
+    lobe: level of the reference that defines the main lobe
+    returns: dict with the rms and maximum of the absolute residuals in the whole map and in the main lobe,
+             and the fraction of the cells of the reference that the maps do not cover
+    """
+    maps = np.asarray(maps)
+    reference = np.asarray(reference)
+    both = np.isfinite(maps) & np.isfinite(reference)
+    in_lobe = both & (np.where(np.isfinite(reference), reference, 0) >= lobe)
+    diff = np.abs(maps - reference)
+
+    def stats(mask):
+        if not mask.any():
+            return np.nan, np.nan
+        return np.sqrt(np.mean(diff[mask]**2)), np.max(diff[mask])
+
+    rms, max_abs = stats(both)
+    lobe_rms, lobe_max_abs = stats(in_lobe)
+    missing = np.isfinite(reference) & ~np.isfinite(maps)
+    return {'rms': rms, 'max_abs': max_abs, 'lobe_rms': lobe_rms, 'lobe_max_abs': lobe_max_abs,
+            'missing': missing.sum() / float(max(np.isfinite(reference).sum(), 1))}
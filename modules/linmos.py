@@ -0,0 +1,271 @@
+"""
+Primary beam correction and mosaicking (linear mosaicking, as MIRIAD linmos) of images and cubes with the
+beam models of make_beam_model.py, without MIRIAD.
+
+The mosaic of the inputs i with beams B_i and noise rms_i is
+
+    mosaic = sum_i(B_i * I_i / rms_i**2) / sum_i(B_i**2 / rms_i**2),   weights = sum_i(B_i**2 / rms_i**2)
+
+where the beam is at least cutoff. With a single input this is the primary beam corrected image, I / B.
+
+The inputs are never held in memory: every input is read plane by plane from a memory map, only the
+pixels of the mosaic that its beam model covers are regridded (see modules.regrid.Regridder), and the two
+sums are accumulated in memory-mapped arrays on disk. The mosaic and the weights are then written plane by
+plane. The memory use is a few planes of the mosaic, whatever the size of the cubes.
+"""
+
+import os
+import shutil
+import tempfile
+
+from astropy.io import fits
+import numpy as np
+
+from modules.fits_io import image_hdu
+from modules.regrid import Regridder, celestial_wcs, read_models
+
+spectral_keys = ['CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CUNIT']
+
+
+def read_beam_models(paths, flip=False):
+    """
+    The models of one beam in all frequency bins, e.g. fits_files/<date>/beam_models/chann_*/<date>_<beam>_I_model.fits
+
+    returns: frequencies of the bins (increasing), models with shape (bin, y, x), header of the first model
+    """
+    models, headers = read_models(paths, flip=flip)
+    freqs = np.array([header['CRVAL3'] for header in headers])
+    order = np.argsort(freqs)
+    return freqs[order], models.reshape((len(paths),) + models.shape[-2:])[order], headers[order[0]]
+
+
+def model_at(freqs, models, freq):
+    """
+    The beam model at a frequency, interpolated linearly between the bins (the first or last bin outside them).
+    Without a frequency (NaN, an image without FREQ axis) the mean of the models of all bins.
+    """
+    if np.isnan(freq):
+        return np.mean(models, axis=0)
+    if len(freqs) == 1 or freq <= freqs[0]:
+        return models[0]
+    if freq >= freqs[-1]:
+        return models[-1]
+    hi = np.searchsorted(freqs, freq)
+    w = (freq - freqs[hi - 1]) / (freqs[hi] - freqs[hi - 1])
+    return (1 - w) * models[hi - 1] + w * models[hi]
+
+
+def freq_axis(header):
+    """
+    The FITS axis number of the FREQ axis, None if there is none.
+    """
+    for axis in range(3, header['NAXIS'] + 1):
+        if header.get('CTYPE{}'.format(axis), '').startswith('FREQ'):
+            return axis
+    return None
+
+
+def plane_freqs(header):
+    """
+    Frequencies of the planes of an image or cube, from its FREQ axis. An image without FREQ axis is a
+    single plane without frequency (NaN).
+    """
+    axis = freq_axis(header)
+    if axis is None:
+        return np.array([np.nan])
+    n = header['NAXIS{}'.format(axis)]
+    return header['CRVAL{}'.format(axis)] + header.get('CDELT{}'.format(axis), 1.) * \
+        (np.arange(n) + 1 - header.get('CRPIX{}'.format(axis), 1.))
+
+
+def spectral_header(header):
+    """
+    The FREQ axis of a header as axis 3, empty if there is none.
+    """
+    axis = freq_axis(header)
+    if axis is None:
+        return {}
+    return dict(('{}3'.format(key), header['{}{}'.format(key, axis)]) for key in spectral_keys
+                if '{}{}'.format(key, axis) in header)
+
+
+def mosaic_header(headers, margin=0):
+    """
+    Header of a mosaic grid that covers all inputs: a SIN projection centred on the mean of their centres,
+    with the pixel size of the first input.
+
+    margin: extra pixels around the inputs
+    """
+    # Mean of the unit vectors of the centres, so RA wraps correctly
+    ra = np.radians([h['CRVAL1'] for h in headers])
+    dec = np.radians([h['CRVAL2'] for h in headers])
+    x, y, z = np.mean(np.cos(dec) * np.cos(ra)), np.mean(np.cos(dec) * np.sin(ra)), np.mean(np.sin(dec))
+    cdelt = abs(headers[0]['CDELT2'])
+
+    header = fits.Header()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = header['NAXIS2'] = 1
+    header['CTYPE1'], header['CTYPE2'] = 'RA---SIN', 'DEC--SIN'
+    header['CRVAL1'] = np.degrees(np.arctan2(y, x)) % 360.
+    header['CRVAL2'] = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    header['CDELT1'], header['CDELT2'] = -cdelt, cdelt
+    header['CRPIX1'] = header['CRPIX2'] = 1.
+    header['CUNIT1'] = header['CUNIT2'] = 'deg'
+    wcs = celestial_wcs(header)
+
+    # The mosaic pixels of the corners and the edges of all inputs
+    xs, ys = [], []
+    for h in headers:
+        nx, ny = h['NAXIS1'], h['NAXIS2']
+        edge_x = np.concatenate([np.arange(nx), np.arange(nx), np.zeros(ny), np.full(ny, nx - 1)])
+        edge_y = np.concatenate([np.zeros(nx), np.full(nx, ny - 1), np.arange(ny), np.arange(ny)])
+        ra, dec = celestial_wcs(h).all_pix2world(edge_x, edge_y, 0)
+        x, y = wcs.all_world2pix(ra, dec, 0)
+        xs.append(x)
+        ys.append(y)
+    xs, ys = np.concatenate(xs), np.concatenate(ys)
+
+    x0, y0 = np.floor(xs.min()) - margin, np.floor(ys.min()) - margin
+    header['NAXIS1'] = int(np.ceil(xs.max()) - x0) + margin + 1
+    header['NAXIS2'] = int(np.ceil(ys.max()) - y0) + margin + 1
+    header['CRPIX1'], header['CRPIX2'] = 1. - x0, 1. - y0
+    return header
+
+
+def grid_header(header):
+    """
+    The celestial grid of an image or cube, e.g. to use an existing image as the grid of the mosaic.
+    """
+    grid = fits.Header()
+    grid['NAXIS'] = 2
+    grid['NAXIS1'], grid['NAXIS2'] = header['NAXIS1'], header['NAXIS2']
+    grid.update(celestial_wcs(header).to_header())
+    return grid
+
+
+class LinmosInput(object):
+    """
+    One image or cube of the mosaic with the models of its beam.
+
+    path: FITS image or cube. The planes are those of the FREQ axis (a single plane without one), of any other
+          axis (e.g. STOKES) the first plane is used
+    freqs, models: the beam models, see read_beam_models
+    model_header: header of the beam models (their grid), the centre is moved to the centre of the input
+    rms: noise of the input, for the weights
+    """
+
+    def __init__(self, path, freqs, models, model_header, rms=1.):
+        self.path = path
+        self.freqs = freqs
+        self.models = models
+        self.model_header = model_header
+        self.rms = rms
+        hdu = fits.open(path)
+        self.header = image_hdu(hdu).header.copy()
+        hdu.close()
+
+    def planes(self):
+        """
+        Memory map of the planes, shape (plane, y, x). Only the planes that are used are read.
+        """
+        hdu = fits.open(self.path, memmap=True)
+        data = image_hdu(hdu).data
+        # FITS axis n is numpy axis ndim - n, the FREQ axis is the only one kept besides the celestial axes
+        axis = freq_axis(self.header)
+        data = data[tuple(slice(None) if n in [1, 2, axis] else 0 for n in range(data.ndim, 0, -1))]
+        if axis is None:
+            data = data[np.newaxis]
+        return hdu, data
+
+
+def linmos(inputs, header, mosaic_path, weights_path, cutoff=0.1, tmpdir=None):
+    """
+    Mosaic the inputs on the grid of header and write the mosaic and the weights, with the FREQ axis of the
+    first input. All inputs must have the same planes.
+
+    inputs: list of LinmosInput
+    header: celestial grid of the mosaic, e.g. from mosaic_header
+    cutoff: leave out the pixels of an input where its beam is below cutoff
+    tmpdir: directory for the accumulated sums (as large as the mosaic cube in float32), default next to the mosaic
+    """
+    freqs = plane_freqs(inputs[0].header)
+    for inp in inputs[1:]:
+        other = plane_freqs(inp.header)
+        if len(other) != len(freqs) or not np.allclose(other, freqs, rtol=1e-9, atol=0, equal_nan=True):
+            raise ValueError('The planes of {} do not match those of {}'.format(inp.path, inputs[0].path))
+
+    mosaic_wcs = celestial_wcs(header)
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    for path in [mosaic_path, weights_path]:
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    if tmpdir is None:
+        tmpdir = os.path.dirname(os.path.abspath(mosaic_path))
+    workdir = tempfile.mkdtemp(prefix='linmos_', dir=tmpdir)
+    try:
+        numerator = np.lib.format.open_memmap(os.path.join(workdir, 'numerator.npy'), mode='w+', dtype=np.float32,
+                                              shape=(len(freqs),) + shape)
+        weights = np.lib.format.open_memmap(os.path.join(workdir, 'weights.npy'), mode='w+', dtype=np.float32,
+                                            shape=(len(freqs),) + shape)
+
+        for inp in inputs:
+            print('Adding {}'.format(inp.path))
+            input_wcs = celestial_wcs(inp.header)
+            # Only the mosaic pixels within the beam model are regridded from the input
+            beam = Regridder(celestial_wcs(inp.model_header, input_wcs.wcs.crval), inp.models.shape[-2:],
+                             mosaic_wcs, shape)
+            image = Regridder(input_wcs, (inp.header['NAXIS2'], inp.header['NAXIS1']), mosaic_wcs, shape,
+                              pixels=beam.inside)
+            pixels, in_beam, in_image = np.intersect1d(beam.inside, image.inside, assume_unique=True,
+                                                       return_indices=True)
+
+            hdu, planes = inp.planes()
+            for p, freq in enumerate(freqs):
+                b = beam.values(model_at(inp.freqs, inp.models, freq))[in_beam]
+                values = image.values(planes[p])[in_image]
+                use = (b >= cutoff) & np.isfinite(values) & np.isfinite(b)
+                numerator[p].reshape(-1)[pixels[use]] += b[use] * values[use] / inp.rms**2
+                weights[p].reshape(-1)[pixels[use]] += b[use]**2 / inp.rms**2
+            hdu.close()
+            numerator.flush()
+            weights.flush()
+
+        # An image without FREQ axis gives a 2D mosaic
+        out_header = header.copy()
+        spectral = spectral_header(inputs[0].header)
+        if spectral:
+            out_header['NAXIS'] = 3
+            out_header['NAXIS3'] = len(freqs)
+            out_header.update(spectral)
+            if 'WCSAXES' in out_header:
+                out_header['WCSAXES'] = 3
+
+        mosaic_out = fits.StreamingHDU(mosaic_path, _image_header(out_header, inputs[0].header.get('BUNIT')))
+        weights_out = fits.StreamingHDU(weights_path, _image_header(out_header))
+        for p in range(len(freqs)):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                plane = np.where(weights[p] > 0, numerator[p] / weights[p], np.nan)
+            mosaic_out.write(plane.astype('>f4'))
+            weights_out.write(np.asarray(weights[p], dtype='>f4'))
+        mosaic_out.close()
+        weights_out.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def _image_header(header, bunit=None):
+    """
+    A primary header for a float32 image with the axes of header.
+    """
+    out = fits.Header()
+    out['SIMPLE'] = True
+    out['BITPIX'] = -32
+    out['NAXIS'] = header['NAXIS']
+    for axis in range(1, header['NAXIS'] + 1):
+        out['NAXIS{}'.format(axis)] = header['NAXIS{}'.format(axis)]
+    for key, value in header.items():
+        if key not in out and key not in ['BITPIX', 'SIMPLE', 'EXTEND']:
+            out[key] = value
+    if bunit:
+        out['BUNIT'] = bunit
+    return out
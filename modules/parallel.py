@@ -0,0 +1,32 @@
+"""
+Running independent jobs (beams, antennas, tasks) in a pool of processes.
+"""
+
+from multiprocessing import Pool
+
+
+def map_jobs(function, jobs, workers=1, initializer=None, initargs=(), chunksize=1):
+    """
+    Apply function to every job, in a pool of worker processes if workers > 1.
+    The results are always returned in the order of the jobs, so the output of a parallel run
+    is written in the same order as that of a serial run.
+
+    function: a module level function that takes one job
+    jobs: list of jobs
+    workers: number of processes (1 runs everything in this process)
+    initializer, initargs: called once in every worker (and once here for a serial run), e.g. to
+                           hand the data that all jobs share to the workers
+    chunksize: number of consecutive jobs that are sent to the same worker
+    """
+    if workers > 1 and len(jobs) > 1:
+        pool = Pool(min(workers, len(jobs)), initializer, initargs)
+        try:
+            for result in pool.imap(function, jobs, chunksize):
+                yield result
+        finally:
+            pool.terminate()
+    else:
+        if initializer is not None:
+            initializer(*initargs)
+        for job in jobs:
+            yield function(job)
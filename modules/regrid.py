@@ -0,0 +1,156 @@
+"""
+Regridding of the beam models (40x40 pixels) onto the grid of a target image, e.g. a continuum image
+or an HI cube, without MIRIAD.
+
+As in CB_analysis/regrid_beam_maps.ipynb, the centre of the model is first moved to the centre of the
+target image (CRVAL1/2), and the model is then resampled on the celestial grid of the target. The
+mapping from the target pixels to the model pixels only depends on the two grids, so it is computed
+once per (model grid, target grid) pair, kept in a cache, and applied to the models of all beams and
+channels at once as a single sparse matrix product (bilinear interpolation).
+"""
+
+import os
+import warnings
+
+from astropy.io import fits
+from astropy.wcs import WCS, FITSFixedWarning
+import numpy as np
+from scipy import sparse
+
+from modules.fits_io import image_hdu, write_image
+
+_regridders = {}
+
+
+def celestial_wcs(header, centre=None):
+    """
+    The celestial (RA, Dec) WCS of a header, with the reference value moved to centre (ra, dec) if given.
+    """
+    with warnings.catch_warnings():
+        # The models have 2 axes but a WCS with 3 (the frequency of the model)
+        warnings.simplefilter('ignore', FITSFixedWarning)
+        wcs = WCS(header).celestial
+    if centre is not None:
+        wcs.wcs.crval = list(centre)
+    return wcs
+
+
+class Regridder(object):
+    """
+    Bilinear interpolation from the pixels of a model grid to the pixels of a target grid.
+
+    model_wcs, model_shape: celestial WCS and (y, x) size of the models
+    target_wcs, target_shape: celestial WCS and (y, x) size of the target image
+    pixels: only map these (flat) target pixels, default all
+    """
+
+    def __init__(self, model_wcs, model_shape, target_wcs, target_shape, pixels=None):
+        self.model_shape = tuple(model_shape)
+        self.target_shape = tuple(target_shape)
+        ny, nx = self.model_shape
+
+        # Model pixel of every target pixel
+        if pixels is None:
+            pixels = np.arange(self.target_shape[0] * self.target_shape[1])
+        ty, tx = np.unravel_index(pixels, self.target_shape)
+        ra, dec = target_wcs.all_pix2world(tx, ty, 0)
+        with np.errstate(invalid='ignore'):
+            px, py = model_wcs.all_world2pix(ra, dec, 0)
+
+        found = np.isfinite(px) & np.isfinite(py) & (px >= 0) & (px <= nx - 1) & (py >= 0) & (py <= ny - 1)
+        self.inside = np.asarray(pixels)[found]        # the target pixels that the models cover
+        px, py = px[found], py[found]
+        x0 = np.clip(np.floor(px).astype(int), 0, max(nx - 2, 0))
+        y0 = np.clip(np.floor(py).astype(int), 0, max(ny - 2, 0))
+        wx, wy = px - x0, py - y0
+        x1, y1 = np.minimum(x0 + 1, nx - 1), np.minimum(y0 + 1, ny - 1)
+
+        rows = np.tile(np.arange(len(self.inside)), 4)
+        cols = np.concatenate([y0 * nx + x0, y0 * nx + x1, y1 * nx + x0, y1 * nx + x1])
+        weights = np.concatenate([(1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx])
+        self.matrix = sparse.csr_matrix((weights, (rows, cols)), shape=(len(self.inside), ny * nx))
+
+    def values(self, models):
+        """
+        models: shape (..., y, x) with the model_shape
+        returns: the values at the target pixels inside the models only, shape (..., len(inside))
+        """
+        models = np.asarray(models, dtype=np.float64)
+        flat = models.reshape(-1, self.model_shape[0] * self.model_shape[1])
+        return self.matrix.dot(flat.T).T.reshape(models.shape[:-2] + (len(self.inside),))
+
+    def __call__(self, models, fill_value=np.nan):
+        """
+        models: shape (..., y, x) with the model_shape, e.g. (beam, channel, y, x)
+        returns: shape (..., y, x) with the target_shape, fill_value outside the models
+        """
+        models = np.asarray(models, dtype=np.float64)
+        if models.shape[-2:] != self.model_shape:
+            raise ValueError('Models with shape {} do not match the grid {} of the regridder'.format(
+                             models.shape[-2:], self.model_shape))
+        batch_shape = models.shape[:-2]
+        values = self.values(models).reshape(-1, len(self.inside))
+
+        result = np.full((values.shape[0], self.target_shape[0] * self.target_shape[1]), fill_value)
+        result[:, self.inside] = values
+        return result.reshape(batch_shape + self.target_shape)
+
+
+def get_regridder(model_header, target_header, centre=None, model_shape=None):
+    """
+    The (cached) regridder from the grid of a model header to the grid of a target header.
+
+    centre: (ra, dec) of the centre of the models, default the reference value (CRVAL1/2) of the target
+    model_shape: (y, x) size of the models, default from NAXIS2/NAXIS1 of the model header
+    """
+    target_wcs = celestial_wcs(target_header)
+    if centre is None:
+        centre = target_wcs.wcs.crval
+    model_wcs = celestial_wcs(model_header, centre)
+    if model_shape is None:
+        model_shape = (model_header['NAXIS2'], model_header['NAXIS1'])
+    target_shape = (target_header['NAXIS2'], target_header['NAXIS1'])
+
+    key = (model_wcs.to_header_string(), tuple(model_shape), target_wcs.to_header_string(), target_shape)
+    if key not in _regridders:
+        _regridders[key] = Regridder(model_wcs, model_shape, target_wcs, target_shape)
+    return _regridders[key]
+
+
+def regridded_header(target_header, model_header):
+    """
+    Header of a regridded model: the celestial axes of the target, the frequency axis of the model.
+    """
+    header = celestial_wcs(target_header).to_header()
+    if 'CTYPE3' in model_header:
+        header['WCSAXES'] = 3
+        for key in ['CTYPE3', 'CRVAL3', 'CDELT3', 'CRPIX3', 'CUNIT3']:
+            if key in model_header:
+                header[key] = model_header[key]
+    return header
+
+
+def read_models(paths, flip=False):
+    """
+    Read the FITS models of make_beam_model.py (or make_beam_model_ant.py) into one array.
+
+    flip: flip the models upside down, for the old models (see change_centre_flip in the notebook)
+    returns: models with shape (model, ..., y, x), list of the headers
+    """
+    models, headers = [], []
+    for path in paths:
+        hdu = fits.open(path)
+        image = image_hdu(hdu)
+        models.append(np.array(image.data))
+        headers.append(image.header.copy())
+        hdu.close()
+    models = np.array(models)
+    if flip:
+        models = np.flip(models, axis=-2)
+    return models, headers
+
+
+def write_regridded(path, model, header, dtype='float64', compress=False):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    write_image(path, model, header, dtype=dtype, compress=compress)
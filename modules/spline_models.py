@@ -0,0 +1,400 @@
+"""
+Spline models of the beams, from the cutouts around the calibrator in the beam cubes.
+
+Every FITS cube is read once: the cutouts of all channels are sliced out of the cube in one read and
+kept in a CutoutCache, so all channels and both outputs (the csv files of beam_spline_fitting.py and
+the FITS models of make_beam_model.py) are made from the same pass over the files.
+
+The fitted splines themselves (knots and coefficients) are stored in one .npz file per date
+(SplineModelWriter), from which SplineModels evaluates any beam, polarisation and channel on an
+arbitrary grid or set of positions without refitting. The file has, for P polarisations, B beams
+and C channels:
+- pols (P), beams (B), chans (C), freqs (C): the axes of the models
+- fitted: bool (P, B, C), which models exist
+- knots_y, knots_x: knots along the rows and columns, (P, B, C, max knots), NaN padded
+- n_knots_y, n_knots_x: number of knots of every model, (P, B, C)
+- coeffs: B-spline coefficients (rows x columns, row major), (P, B, C, max coeffs), NaN padded
+- degrees: (ky, kx); px_width; cdelt: CDELT1/2 of the cubes in degrees
+"""
+
+import os
+
+from astropy.io import fits
+import numpy as np
+from numpy import arange
+import pandas as pd
+from scipy.interpolate import BSpline, RectBivariateSpline, make_interp_spline
+
+from modules.fits_io import image_hdu, write_image
+
+
+def read_cutouts(path, px_width=20, nan_to_num=True, flip=True):
+    """
+    The [CRPIX - px_width:CRPIX + px_width] cutouts of all channels of a cube, NaN set to 0 and
+    flipped upside down, as used for the spline fitting.
+
+    nan_to_num: set NaN to 0 (make_beam_model_ant.py fits the cutouts as they are)
+    flip: flip the cutouts upside down
+    returns: cutouts with shape (chan, y, x), header of the cube
+    """
+    hdu = fits.open(path, memmap=True)
+    image = image_hdu(hdu)
+    header = image.header.copy()
+    crpix1, crpix2 = int(header['CRPIX1']), int(header['CRPIX2'])
+    cutouts = np.array(image.data[:, crpix2 - px_width:crpix2 + px_width, crpix1 - px_width:crpix1 + px_width])
+    hdu.close()
+
+    if nan_to_num:
+        cutouts = np.nan_to_num(cutouts)
+    if flip:
+        cutouts = np.flip(cutouts, axis=1)
+    return cutouts, header
+
+
+def beam_number(path):
+    """
+    Beam number of a beam cube, from a file name <calibrator>_<date>_<beam>_<pol>.fits
+    """
+    return int(os.path.basename(path).split('_')[-2])
+
+
+class CutoutCache(object):
+    """
+    Cutouts of the cubes, read on first use and kept for all later channels and outputs.
+    """
+
+    def __init__(self, px_width=20):
+        self.px_width = px_width
+        self._cutouts = {}
+
+    def get(self, path):
+        """
+        returns: cutouts with shape (chan, y, x), header of the cube (see read_cutouts)
+        """
+        if path not in self._cutouts:
+            self._cutouts[path] = read_cutouts(path, self.px_width)
+        return self._cutouts[path]
+
+    def cutouts(self, path):
+        return self.get(path)[0]
+
+    def header(self, path):
+        return self.get(path)[1]
+
+    def clear(self):
+        self._cutouts = {}
+
+
+def fit_spline(cutout):
+    """
+    RectBivariateSpline fit of a cutout, with the rows (y) as the first coordinate.
+    """
+    x = arange(0, cutout.shape[1])
+    y = arange(0, cutout.shape[0])
+    return RectBivariateSpline(y, x, cutout)
+
+
+def spline_model(cutout, spline=None):
+    """
+    Spline fit of a cutout, evaluated on the pixels of the cutout.
+
+    spline: the fit of the cutout if it was already made
+    """
+    if spline is None:
+        spline = fit_spline(cutout)
+    x = arange(0, cutout.shape[1])
+    y = arange(0, cutout.shape[0])
+    return spline(y, x)
+
+
+def write_spline_csv(path, models, freq):
+    """
+    Write the models of all beams of one channel into a csv file with one column per beam.
+    """
+    df = pd.DataFrame()
+    maxlen = len(models[0].flatten())
+    for b, m in enumerate(models):
+        col = list(m.flatten())
+        if maxlen != len(col):
+            col.extend(['']*(maxlen-len(col)))
+        df['B{:02}_{}'.format(b, int(freq))] = col   # the column name is the beam number and the frequency
+
+    df.to_csv(path)
+
+
+def write_model_fits(path, model, header, freq, px_width=20, dtype='float64', compress=False):
+    """
+    Write the model of one beam and channel, with the header of the measured cube moved to the cutout.
+    """
+    h_measured = header.copy()
+    h_measured['NAXIS1'] = int(px_width * 2)
+    h_measured['NAXIS2'] = int(px_width * 2)
+    h_measured['NAXIS3'] = 1
+    h_measured['CRPIX1'] = px_width
+    h_measured['CRPIX2'] = px_width
+    h_measured['CRVAL3'] = freq
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    write_image(path, model, h_measured, dtype=dtype, compress=compress)
+
+
+_shared = {}
+
+
+def init_antenna_worker(basedir, date, chans, px_width=20, dtype='float64', compress=False):
+    """
+    Settings that all antenna_model jobs share (see modules.parallel.map_jobs).
+
+    chans: the channels (frequency bins) to model
+    dtype, compress: see modules.fits_io.write_image
+    """
+    _shared.update({'basedir': basedir, 'date': date, 'chans': chans, 'px_width': px_width, 'dtype': dtype,
+                    'compress': compress})
+
+
+def antenna_model_path(basedir, date, ant, beam):
+    return os.path.join(basedir, 'fits_files', date, 'ant_{}'.format(ant), 'beam_models',
+                        '{}_{:02}_I_model.fits'.format(date, beam))
+
+
+def antenna_model(job):
+    """
+    Fit all channels of the Stokes I cube of one antenna and beam, and write them as one model cube.
+    The cube is read once for all channels.
+
+    job: (ant, beam, path of the cube)
+    returns: (ant, beam, 'ok' or 'failed', message)
+    """
+    ant, beam, path = job
+    px_width = _shared['px_width']
+    try:
+        cutouts, header = read_cutouts(path, px_width, nan_to_num=False)
+        if cutouts.shape[1:] != (2 * px_width, 2 * px_width):
+            raise ValueError('the {0}x{0} pixel cutout does not fit in the map'.format(2 * px_width))
+        if len(cutouts) < len(_shared['chans']):
+            raise ValueError('the cube has {} channels, {} are modelled'.format(len(cutouts), len(_shared['chans'])))
+
+        model = np.array([np.flipud(spline_model(cutouts[chan])) for chan in _shared['chans']])  # 40x40 pixel models
+
+        header['NAXIS1'] = int(px_width * 2)
+        header['NAXIS2'] = int(px_width * 2)
+        header['CRPIX1'] = px_width
+        header['CRPIX2'] = px_width
+
+        out = antenna_model_path(_shared['basedir'], _shared['date'], ant, beam)
+        if not os.path.exists(os.path.dirname(out)):
+            os.makedirs(os.path.dirname(out))
+        write_image(out, model, header, dtype=_shared['dtype'], compress=_shared['compress'])
+    except Exception as e:
+        return ant, beam, 'failed', '{}: {}'.format(type(e).__name__, e)
+    return ant, beam, 'ok', ''
+
+
+def spline_models_path(basedir, date):
+    return os.path.join(basedir, 'spline', date, 'beam_models_{}_splines.npz'.format(date))
+
+
+class SplineModelWriter(object):
+    """
+    Collect the spline fits of a date and write them to one .npz file.
+
+    px_width: half width of the cutouts
+    cdelt: (CDELT1, CDELT2) of the cubes, to evaluate the models at offsets in degrees
+    """
+
+    def __init__(self, px_width, cdelt):
+        self.px_width = px_width
+        self.cdelt = cdelt
+        self.splines = {}
+        self.freqs = {}
+
+    def add(self, pol, beam, chan, freq, spline):
+        self.splines[(pol, beam, chan)] = spline
+        self.freqs[chan] = freq
+
+    def write(self, path):
+        keys = sorted(self.splines)
+        pols = sorted(set(k[0] for k in keys))
+        beams = sorted(set(k[1] for k in keys))
+        chans = sorted(self.freqs)
+
+        shape = (len(pols), len(beams), len(chans))
+        max_knots = max(max(len(t) for t in spline.get_knots()) for spline in self.splines.values())
+        max_coeffs = max(len(spline.get_coeffs()) for spline in self.splines.values())
+        fitted = np.zeros(shape, dtype=bool)
+        n_knots_y = np.zeros(shape, dtype=int)
+        n_knots_x = np.zeros(shape, dtype=int)
+        knots_y = np.full(shape + (max_knots,), np.nan)
+        knots_x = np.full(shape + (max_knots,), np.nan)
+        coeffs = np.full(shape + (max_coeffs,), np.nan)
+
+        for (pol, beam, chan), spline in self.splines.items():
+            i = (pols.index(pol), beams.index(beam), chans.index(chan))
+            ty, tx = spline.get_knots()
+            c = spline.get_coeffs()
+            fitted[i] = True
+            n_knots_y[i], n_knots_x[i] = len(ty), len(tx)
+            knots_y[i][:len(ty)] = ty
+            knots_x[i][:len(tx)] = tx
+            coeffs[i][:len(c)] = c
+
+        degrees = self.splines[keys[0]].degrees
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        np.savez_compressed(path, pols=np.array(pols), beams=np.array(beams), chans=np.array(chans),
+                            freqs=np.array([self.freqs[c] for c in chans]), fitted=fitted,
+                            knots_y=knots_y, knots_x=knots_x, n_knots_y=n_knots_y, n_knots_x=n_knots_x,
+                            coeffs=coeffs, degrees=np.array(degrees), px_width=self.px_width,
+                            cdelt=np.array(self.cdelt, dtype=np.float64))
+
+
+class SplineModels(object):
+    """
+    The spline fits of a date, as written by beam_spline_fitting.py, evaluated on demand.
+
+    Positions are pixels of the cutouts (x: column, y: row), as in the csv files and the FITS models
+    of make_beam_model.py; the pixel scale is free, e.g. np.linspace(0, 39, 4000) samples a model on
+    a 100 times finer grid. Outside the cutout the models are fill_value.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as f:
+            self.meta = dict((k, f[k]) for k in f.files)
+        self.pols = [str(p) for p in self.meta['pols']]
+        self.beams = [int(b) for b in self.meta['beams']]
+        self.chans = [int(c) for c in self.meta['chans']]
+        self.freqs = self.meta['freqs']
+        self.px_width = int(self.meta['px_width'])
+        self.ky, self.kx = (int(k) for k in self.meta['degrees'])
+
+    def _index(self, pol, beam, chan):
+        try:
+            i = (self.pols.index(pol), self.beams.index(beam), self.chans.index(chan))
+        except ValueError:
+            raise KeyError('No model for pol {}, beam {} and channel {} in {}'.format(pol, beam, chan, self.path))
+        if not self.meta['fitted'][i]:
+            raise KeyError('No model for pol {}, beam {} and channel {} in {}'.format(pol, beam, chan, self.path))
+        return i
+
+    def tck(self, pol, beam, chan):
+        """
+        Knots along the rows and the columns, and the coefficients with shape (rows, columns).
+        """
+        i = self._index(pol, beam, chan)
+        ty = self.meta['knots_y'][i][:self.meta['n_knots_y'][i]]
+        tx = self.meta['knots_x'][i][:self.meta['n_knots_x'][i]]
+        c = self.meta['coeffs'][i][:(len(ty) - self.ky - 1) * (len(tx) - self.kx - 1)]
+        return ty, tx, c.reshape(len(ty) - self.ky - 1, len(tx) - self.kx - 1)
+
+    def evaluate(self, pol, beam, chan, x, y, grid=True, fill_value=np.nan):
+        """
+        x, y: pixel positions
+        grid: evaluate on the grid of x (columns) and y (rows) and return shape (len(y), len(x)),
+              else at the points (x, y) and return the shape of x
+        """
+        ty, tx, c = self.tck(pol, beam, chan)
+        return _evaluate(ty, tx, self.ky, self.kx, c, x, y, grid, fill_value)
+
+    def frequency_model(self, pol, beam, k=3):
+        """
+        The model of a beam and polarisation that is continuous in frequency, see FrequencyModel.
+        """
+        fitted = self.meta['fitted']
+        chans = [chan for c, chan in enumerate(self.chans)
+                 if pol in self.pols and beam in self.beams and fitted[self.pols.index(pol), self.beams.index(beam), c]]
+        if not chans:
+            raise KeyError('No models for pol {} and beam {} in {}'.format(pol, beam, self.path))
+        tcks = [self.tck(pol, beam, chan) for chan in chans]
+        ty, tx = tcks[0][:2]
+        for chan, tck in zip(chans, tcks):
+            if not (np.array_equal(tck[0], ty) and np.array_equal(tck[1], tx)):
+                raise ValueError('The models of beam {} ({}) do not have the same knots in all channels, '
+                                 'channel {} differs'.format(beam, pol, chan))
+        freqs = [self.freqs[self.chans.index(chan)] for chan in chans]
+        return FrequencyModel(freqs, ty, tx, self.ky, self.kx, np.array([tck[2] for tck in tcks]), k=k,
+                              pixels=self.pixels)
+
+    def pixels(self, dx, dy):
+        """
+        Pixel positions of offsets in degrees from the reference pixel of the FITS models (CRPIX1/2 = px_width).
+        """
+        cdelt1, cdelt2 = self.meta['cdelt']
+        return (self.px_width - 1 + np.asarray(dx) / cdelt1, self.px_width - 1 + np.asarray(dy) / cdelt2)
+
+    def evaluate_offsets(self, pol, beam, chan, dx, dy, grid=True, fill_value=np.nan):
+        """
+        As evaluate, at offsets in degrees (dx along RA, dy along Dec) from the reference pixel of the models.
+        """
+        x, y = self.pixels(dx, dy)
+        return self.evaluate(pol, beam, chan, x, y, grid=grid, fill_value=fill_value)
+
+
+class FrequencyModel(object):
+    """
+    Model of one beam and polarisation in x, y and frequency. The spline fits of the channel bins share their
+    knots, so their coefficients are interpolated in frequency with a spline of degree k: the model is a tensor
+    product spline that goes through the model of every bin at the frequency of the bin.
+
+    freqs: frequencies of the bins, coeffs: coefficients of the bins, shape (bin, rows, columns)
+    ty, tx, ky, kx: knots and degrees of the spatial splines
+    pixels: function that converts offsets in degrees to pixels (SplineModels.pixels)
+    """
+
+    def __init__(self, freqs, ty, tx, ky, kx, coeffs, k=3, pixels=None):
+        order = np.argsort(freqs)
+        self.freqs = np.asarray(freqs, dtype=np.float64)[order]
+        self.ty, self.tx, self.ky, self.kx = ty, tx, ky, kx
+        self.spline = make_interp_spline(self.freqs, np.asarray(coeffs)[order], k=min(k, len(self.freqs) - 1), axis=0)
+        self._pixels = pixels
+
+    def evaluate(self, freqs, x, y, grid=True, fill_value=np.nan, extrapolate=False):
+        """
+        freqs: frequencies in Hz, e.g. the spectral axis of a cube
+        x, y, grid, fill_value: see SplineModels.evaluate
+        extrapolate: extrapolate outside the frequencies of the bins, else fill_value
+        returns: shape (len(freqs), len(y), len(x)), or (len(freqs),) + x.shape if not grid
+        """
+        freqs = np.atleast_1d(np.asarray(freqs, dtype=np.float64))
+        coeffs = self.spline(freqs, extrapolate=extrapolate)          # shape (freq, rows, columns)
+        values = _evaluate(self.ty, self.tx, self.ky, self.kx, coeffs, x, y, grid, fill_value)
+        values[~np.isfinite(coeffs[:, 0, 0])] = fill_value
+        return values
+
+    def evaluate_offsets(self, freqs, dx, dy, grid=True, fill_value=np.nan, extrapolate=False):
+        """
+        As evaluate, at offsets in degrees from the reference pixel of the models (see SplineModels.pixels).
+        """
+        x, y = self._pixels(dx, dy)
+        return self.evaluate(freqs, x, y, grid=grid, fill_value=fill_value, extrapolate=extrapolate)
+
+
+def _evaluate(ty, tx, ky, kx, c, x, y, grid, fill_value):
+    """
+    Tensor product spline with coefficients c, shape (..., rows, columns), at the pixels x, y.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    by = _basis(ty, ky, y.ravel())
+    bx = _basis(tx, kx, x.ravel())
+    if grid:
+        values = np.matmul(np.matmul(by, c), bx.T)
+        values[..., ~np.isfinite(by[:, 0]), :] = fill_value
+        values[..., ~np.isfinite(bx[:, 0])] = fill_value
+        return values
+    values = np.sum(np.matmul(by, c) * bx, axis=-1)
+    values[..., ~(np.isfinite(by[:, 0]) & np.isfinite(bx[:, 0]))] = fill_value
+    return values.reshape(c.shape[:-2] + x.shape)
+
+
+def _basis(t, k, x):
+    """
+    Values of the B-spline basis functions of knots t and degree k at x, shape (len(x), len(t) - k - 1).
+    Rows outside the base interval are NaN.
+    """
+    inside = (x >= t[k]) & (x <= t[-k - 1])
+    basis = np.full((len(x), len(t) - k - 1), np.nan)
+    if inside.any():
+        basis[inside] = BSpline.design_matrix(x[inside], t, k).toarray()
+    return basis
@@ -4,6 +4,7 @@
 This script copies drift scan files from ALTA to happili. 
 Then extracts the auto correlation data for each antenna in 10 frequency bins into a csv file.
 Then cleans up space on happili
+With -m 2 (or more) the next task is copied while the current task is extracted.
 Based on scripts by Helga Denes (denes@astron.nl) and K.M.Hess (hess@astro.rug.nl)
 
 input: 
@@ -11,6 +12,8 @@ input:
 - Select plots or no plots (this does not work at the moment)
 
 Example: ./prepare_drift_data.py -f task_id_lists/task_ids.txt 
+         ./prepare_drift_data.py -f task_id_lists/task_ids.txt -m 2 -w 8
+         ./prepare_drift_data.py -f task_id_lists/task_ids.txt --pols xx,yy --compound_only
 
 """
 
@@ -23,15 +26,25 @@ __version__ = "0.1"
 
 import os
 import sys
+import threading
 from argparse import ArgumentParser, RawTextHelpFormatter
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 import pandas as pd
 import drift_scan_auto_corr_frequency as ds
+from modules import drift_store
 import plots as plots
 
 #-------------------------------------------
 # read in list of task ids
 #-------------------------------------------
 
+fetch_cmd = ('iget -rfPIT -X ./{task_id}-icat.irods-status --lfrestart ./{task_id}-icat.lf-irods-status --retries 5 '
+             '/altaZone/archive/apertif_main/visibilities_default/{task_id} {data_location}')
+
+
 def parse_args():
 
     parser = ArgumentParser(
@@ -42,62 +55,154 @@ def parse_args():
                         help="File with task_ids. (default: '%(default)s').")
     parser.add_argument('-p', "--plot", default=False,
                         help="If True make plots")
+    parser.add_argument('-r', '--chunk_rows', default=120, type=int,
+                        help="Number of MS rows to read at once, sets the memory use. (default: '%(default)s').")
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help="Number of beams to extract in parallel processes. (default: '%(default)s').")
+    parser.add_argument('-e', '--output_format', default='csv', choices=['store', 'csv', 'both'],
+                        help="Write the extracted data into a binary store, a csv file or both. (default: '%(default)s').")
+    parser.add_argument('-m', '--max_on_disk', default=1, type=int,
+                        help="Maximum number of tasks that are copied but not yet extracted and removed, including failed tasks.\n"
+                             "Use 2 or more to copy the next task while the current one is extracted. (default: '%(default)s').")
+    parser.add_argument('--fetch_cmd', default=fetch_cmd,
+                        help="Command to copy a task into the data location, with {task_id} and {data_location}\n"
+                             "placeholders, e.g. 'cp -r /local/copy/{task_id} {data_location}'. (default: '%(default)s').")
+    parser.add_argument('--pols', default=','.join(ds.pols),
+                        help="Polarisations to extract, separated by commas. The beam maps only use 'xx,yy'.\n"
+                             "(default: '%(default)s').")
+    parser.add_argument('--compound_only', action='store_true',
+                        help="Only extract the compound beams (the average of the antennas), not every antenna.")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore the extraction manifests and extract all tasks and beams again.")
 
     args = parser.parse_args()
+    # The polarisations in the order of the correlations in the MS
+    selected = args.pols.split(',')
+    unknown = [pol for pol in selected if pol not in ds.pols]
+    if unknown:
+        parser.error('unknown polarisations: {}'.format(', '.join(unknown)))
+    args.pols = [pol for pol in ds.pols if pol in selected]
     return args
 
 
-args = parse_args()
-with open(args.task_ids) as f:
-    task_id = f.read().splitlines()
-
-#-------------------------------------------
-# copy files from alta
-# extract autocorrelation data into csv table
-# delet ms files
-#-------------------------------------------
-
-#data_location = '/data/apertif/driftscans/'
-data_location = '/tank/apertif/driftscans/'
-
-# First apertif frequency setting uses these numbers, central freq:1280 MHz
-#chan_range = [14000, 24500]  # RFI free channels to be used, there are 24576 channels all together with 384 subbands, each subband has 64 channels  
-#bin_num = 10  # number of bins
-
-# revised, second apertif frequency setting uses these numbers, central freq:1370 MHz
-chan_range = [6500, 24500]  # RFI free channels to be used, there are 24576 channels all together with 384 subbands, each subband has 64 channels  
-bin_num = 18  # number of bins (18 for new freq range, 10 for old)
+def main():
+
+	args = parse_args()
+	with open(args.task_ids) as f:
+		task_id = f.read().splitlines()
+
+	#-------------------------------------------
+	# copy files from alta
+	# extract autocorrelation data into csv table
+	# delet ms files
+	#-------------------------------------------
+
+	#data_location = '/data/apertif/driftscans/'
+	data_location = '/tank/apertif/driftscans/'
+
+	# First apertif frequency setting uses these numbers, central freq:1280 MHz
+	#chan_range = [14000, 24500]  # RFI free channels to be used, there are 24576 channels all together with 384 subbands, each subband has 64 channels  
+	#bin_num = 10  # number of bins
+
+	# revised, second apertif frequency setting uses these numbers, central freq:1370 MHz
+	chan_range = [6500, 24500]  # RFI free channels to be used, there are 24576 channels all together with 384 subbands, each subband has 64 channels  
+	bin_num = 18  # number of bins (18 for new freq range, 10 for old)
+
+	# Tasks that were extracted before with the same settings are not copied again
+	todo = []
+	for tid in task_id:
+		if not args.restart and ds.task_complete(data_location, tid, chan_range, bin_num,
+												 output_format=args.output_format, read_pols=args.pols,
+												 per_antenna=not args.compound_only):
+			print("{} has already been extracted, skipping".format(tid))
+		else:
+			todo.append(tid)
+
+	# Interrupted tasks whose MS files are still on disk are resumed without copying them again
+	on_disk = set(tid for tid in todo if not args.restart and
+				  ds.task_resumable(data_location, tid, chan_range, bin_num, read_pols=args.pols,
+									per_antenna=not args.compound_only))
+
+	# Copy the tasks in a background thread, so the next task is copied while the current one is extracted.
+	# At most max_on_disk tasks are copied and not yet extracted and cleaned up (or failed) at any time.
+	slots = threading.Semaphore(args.max_on_disk)
+	fetched = Queue()
+	fetcher = threading.Thread(target=fetch_tasks,
+							   args=(todo, args.fetch_cmd, data_location, slots, fetched, on_disk))
+	fetcher.daemon = True
+	fetcher.start()
+
+	# The slot of a task that failed to extract is kept, as its MS files stay on disk. Once max_on_disk
+	# failed tasks are on disk no more tasks are copied.
+	failed = []
+	for i in range(len(todo)):
+		tid = fetched.get()
+		if extract_task(args, tid, data_location, chan_range, bin_num):
+			slots.release()
+			continue
+		failed.append(tid)
+		if len(failed) >= args.max_on_disk:
+			print("{} failed tasks are on disk ({}), not copying the remaining {} tasks".format(
+				len(failed), ', '.join(failed), len(todo) - i - 1))
+			break
+
+
+def fetch_tasks(task_ids, fetch_cmd, data_location, slots, fetched, on_disk=()):
+	"""
+	Copy the tasks one by one with fetch_cmd and put each task_id in the fetched queue when it is done.
+	A slot is taken before each copy, and released by the main loop after the task has been extracted.
+	The tasks in on_disk are not copied again, they go into the queue straight away.
+	"""
+	for tid in task_ids:
+		slots.acquire()
+		if tid in on_disk:
+			print("{} is still on disk, resuming without copying".format(tid))
+			fetched.put(tid)
+			continue
+		print("Copying data for {}".format(tid))
+		try:
+			os.system(fetch_cmd.format(task_id=tid, data_location=data_location))
+		except Exception as e:
+			print(e)
+		fetched.put(tid)
+
+
+def extract_task(args, tid, data_location, chan_range, bin_num):
+	"""
+	Extract the data of a task that has been copied, remove the MS files and create plots.
+	Tasks that fail to extract are left on disk, so they can be resumed.
+	returns: False if the task failed and its MS files are still on disk
+	"""
+	if not os.path.isdir(os.path.join(data_location, tid)):
+		print("Could not find {}".format(tid))
+		return True
 
-for i in range(len(task_id)):
-	print("Copying data for {}".format(task_id[i]))
-	try:
-		os.system('iget -rfPIT -X ./{0}-icat.irods-status --lfrestart ./{0}-icat.lf-irods-status --retries 5 /altaZone/archive/apertif_main/visibilities_default/{0} {1}'.format(task_id[i], data_location))
-		#os.system('iget -r /altaZone/archive/apertif_main/visibilities_default/{} '.format(task_id[i])+data_location)
-	except Exception as e:
-		print(e)
-		continue
-	
-	if not os.path.isdir(os.path.join(data_location, task_id[i])):
-		print("Could not find {}".format(task_id[i]))
-		continue
-	
 	print("Extracting data")
 	try:
-		ds.data_to_csv(data_location, task_id[i], chan_range, bin_num)
+		ds.data_to_csv(data_location, tid, chan_range, bin_num, chunk_rows=args.chunk_rows, workers=args.workers,
+					   output_format=args.output_format, resume=not args.restart, read_pols=args.pols,
+					   per_antenna=not args.compound_only)
 	except Exception as e:
-		print('{} Failed:'.format(task_id[i]), e)
-		continue
+		print('{} Failed:'.format(tid), e)
+		return False
 	
-	print('rm -rf {}{}/WSRTA*.MS'.format(data_location, task_id[i]))
-	os.system('rm -rf {}{}/WSRTA*.MS'.format(data_location, task_id[i]))
+	print('rm -rf {}{}/WSRTA*.MS'.format(data_location, tid))
+	os.system('rm -rf {}{}/WSRTA*.MS'.format(data_location, tid))
 	
 	# Creating plots
 	if args.plot == 'True':
 		print("Creating plots")
-		data = pd.read_csv('{}{}/{}_exported_data_frequency_split.csv'.format(data_location,task_id[i], task_id[i]))
+		csv_file = '{}{}/{}_exported_data_frequency_split.csv'.format(data_location,tid, tid)
+		if os.path.exists(csv_file):
+			data = pd.read_csv(csv_file)
+		else:
+			data = drift_store.DriftStore(drift_store.store_path(data_location, tid)).to_dataframe()
 
-		plots.plot_all_beams(task_id[i], data, data_location)
-		plots.plot_all_beams_antenna(task_id[i], data, data_location)
+		plots.plot_all_beams(tid, data, data_location)
+		plots.plot_all_beams_antenna(tid, data, data_location)
 
+	return True
 
 
+if __name__ == '__main__':
+	main()
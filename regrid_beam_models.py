@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+This script regrids the beam models of make_beam_model.py onto the grid of a target image (e.g. a
+continuum image or an HI cube), as CB_analysis/regrid_beam_maps.ipynb does with MIRIAD regrid. The
+centre of the models is moved to the centre of the target, and all beams and channels that share a
+target are regridded in one go (see modules/regrid.py).
+
+input:
+- The date of the beam models
+- A target image, or a pattern with the beam number for a target per beam
+
+Example: python regrid_beam_models.py -d '201028' -t /tank/denes/continuum_images/continuum_b{:02}.fits -n 5
+        python regrid_beam_models.py -d '200430' -t /tank/denes/drift_scan/HI_mom0.fits -n '4,6,9' --flip
+
+"""
+
+__author__ = "Helga Denes"
+__date__ = "$29-aug-2019 16:00:00$"
+__version__ = "0.1"
+
+import os
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from astropy.io import fits
+
+from modules.fits_io import dtypes, image_hdu
+from modules.regrid import get_regridder, read_models, regridded_header, write_regridded
+
+
+def parse_args():
+
+    parser = ArgumentParser(
+        description="Regrid the beam models onto the grid of a target image",
+        formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('-o', '--basedir', default='/tank/apertif/driftscans/',
+                        help="Specify the root directory. \n(default: '%(default)s').")
+    parser.add_argument('-d', '--date', default="test",
+                        help="Date of the beam models. \n(default: '%(default)s').")
+    parser.add_argument('-t', '--target', required=True,
+                        help="Target FITS image. A pattern like continuum_b{:02}.fits is formatted \n" +
+                             "with the beam number, for a different target per beam.")
+    parser.add_argument('-b', '--beams', default='0,39',
+                        help="Specify the first and the last beam as a string. \n(default: '%(default)s').")
+    parser.add_argument('-n', '--channels', default='5',
+                        help="Channels (frequency bins) of the models, separated by commas. \n(default: '%(default)s').")
+    parser.add_argument('-p', '--pol', default='I',
+                        help="Polarisation of the models. \n(default: '%(default)s').")
+    parser.add_argument('--flip', action='store_true',
+                        help="Flip the models upside down first (for the old beam models).")
+    parser.add_argument('--outdir', default=None,
+                        help="Output directory. \n(default: fits_files/<date>/beam_models_regrid/ in the root directory).")
+    parser.add_argument('--dtype', default='float32', choices=sorted(dtypes),
+                        help="Data type of the FITS files. \n(default: '%(default)s').")
+    parser.add_argument('--compress', action='store_true',
+                        help="Write lossless tile compressed FITS files.")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+
+    args = parse_args()
+    date = args.date
+    beam_range = args.beams.split(',')
+    beams = range(int(beam_range[0]), int(beam_range[1])+1)
+    chans = [int(c) for c in args.channels.split(',')]
+    outdir = args.outdir
+    if outdir is None:
+        outdir = os.path.join(args.basedir, 'fits_files', date, 'beam_models_regrid')
+
+    # The beams that share a target image are regridded together
+    targets = {}
+    for beam in beams:
+        targets.setdefault(args.target.format(beam), []).append(beam)
+
+    for target, target_beams in sorted(targets.items()):
+        hdu = fits.open(target)
+        target_header = image_hdu(hdu).header.copy()
+        hdu.close()
+
+        paths = [os.path.join(args.basedir, 'fits_files', date, 'beam_models', 'chann_{}'.format(chan),
+                              '{}_{:02}_{}_model.fits'.format(date, beam, args.pol))
+                 for beam in target_beams for chan in chans]
+        missing = [path for path in paths if not os.path.exists(path)]
+        if missing:
+            print('Skipping {}, missing models: {}'.format(target, ', '.join(missing)))
+            continue
+
+        models, model_headers = read_models(paths, flip=args.flip)
+        print('Regridding {} models onto {}'.format(len(paths), target))
+        regridded = get_regridder(model_headers[0], target_header)(models)
+
+        for path, model, model_header in zip(paths, regridded, model_headers):
+            header = regridded_header(target_header, model_header)
+            chan_dir = os.path.basename(os.path.dirname(path))
+            write_regridded(os.path.join(outdir, chan_dir, os.path.basename(path)[:-len('.fits')] + '_reg.fits'),
+                            model[None], header, dtype=args.dtype, compress=args.compress)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# scan2fits: Create XX & YY beam models from drift scans
+# K.M.Hess 19/02/2019 (hess@astro.rug.nl)
+# edited by H. Denes 08/06/2021 (denes@astron.nl)
+__author__ = "Kelley M. Hess"
+__date__ = "$04-jun-2019 16:00:00$"
+__version__ = "0.2"
+
+"""
+This script creates fits cubes from drift scan data, using the previously extracted data.
+It makes the cubes of the compound beams and/or of the beams of the individual antennas, for the old
+(centered at 1280 MHz) or the new (centered at 1370 MHz) frequency setup. The data is read and
+gridded once for the compound beam and all antennas.
+
+input:
+- A file with the list of task_ids
+- The frequency setup
+
+Example: python scan2fits.py -f ./task_id_lists/task_ids_210205.txt -d '210205' -s new
+        python scan2fits.py -f ./task_id_lists/task_ids_190303.txt -d '190303' -s old -m compound -b '1,7'
+
+"""
+
+import os
+import time
+import warnings
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+import astropy.units as u
+import pandas as pd
+
+from modules.beam_maps import beam_cubes, beam_geometry, init_worker, select_tasks
+from modules.catalogue import apparent_coordinates, get_calibrator
+from modules.cube_store import CubeStoreWriter, beam_header, cube_store_path, fits_path, write_fits_cubes
+from modules.drift_coords import task_offsets
+from modules.drift_qc import screen_drifts, write_qc_report
+from modules.drift_store import read_drift_data
+from modules.fits_io import dtypes
+from modules.freq_setups import freq_setups, get_setup, spectral_axis
+from modules.gridding import gridders
+from modules.parallel import map_jobs
+
+map_types = ['compound', 'antennas', 'both']
+
+
+def make_gifs(root):
+
+    os.system('convert -delay 50 {}*db0_reconstructed.png {}all_beams0.gif'.format(root, root))
+    os.system('convert -delay 50 {}*_difference.png {}diff_xx-yy.gif'.format(root, root))
+
+    return
+
+
+def parse_args(setup=None, maps=None):
+    """
+    setup, maps: fix the frequency setup and the type of maps instead of taking them from the command line
+    """
+
+    parser = ArgumentParser(
+        description="Make cubes of all 40 beams from drift scans.",
+        formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('-c', '--calibname', default='Cyg A',
+                        help="Specify the calibrator. (default: '%(default)s').")
+    parser.add_argument('--resolve', action='store_true',
+                        help="Resolve a calibrator that is not in the offline catalogue over the network.")
+    parser.add_argument('-f', "--task_ids", default="",
+                        help="A file with a list of task_ids. (default: '%(default)s').")
+    parser.add_argument('-o', '--basedir', default='/tank/apertif/driftscans/',
+                        help="Specify the root directory. \n(default: '%(default)s').")
+    parser.add_argument('-b', '--beams', default='0,39',
+                        help="Specify the first and the last beam as a string. \n(default: '%(default)s').")
+    if setup is None:
+        parser.add_argument('-s', '--setup', default='new', choices=sorted(freq_setups),
+                            help="Frequency setup of the observations: \n" +
+                                 "\n".join("{}: {}".format(s.name, s.description) for s in sorted(freq_setups.values())) +
+                                 "\n(default: '%(default)s').")
+    if maps is None:
+        parser.add_argument('-m', '--maps', default='both', choices=map_types,
+                            help="Make the maps of the compound beams, the antennas or both. \n(default: '%(default)s').")
+    if setup is None:
+        parser.add_argument('-n', '--bin_num', default=None, type=int,
+                            help="Number of frequency bins. \n(default: " +
+                                 ", ".join("{} for {}".format(s.bin_num, s.name) for s in sorted(freq_setups.values())) + ").")
+    else:
+        parser.add_argument('-n', '--bin_num', default=get_setup(setup).bin_num, type=int,
+                            help="Number of frequency bins. \n(default: '%(default)s').")
+    parser.add_argument('-d', '--date', default="test",
+                        help="Date for the output name. \n(default: '%(default)s').")
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help="Number of parallel processes for the beam maps. \n(default: '%(default)s').")
+    parser.add_argument('-x', '--crop', default=None, type=int,
+                        help="Only make the maps within this many pixels of the calibrator, e.g. 20 for the \n" +
+                             "40x40 pixel region used by the spline fitting. (default: the full maps).")
+    parser.add_argument('-g', '--gridder', default='cubic', choices=sorted(gridders),
+                        help="Gridding backend: cubic (the reference), linear (on the same triangulation) or \n" +
+                             "binning (no triangulation, for quick look maps). \n(default: '%(default)s').")
+    parser.add_argument('--report', action='store_true',
+                        help="Also grid with the cubic backend and write the residuals per beam to a csv file.")
+    parser.add_argument('-e', '--output_format', default='fits', choices=['fits', 'cube', 'both'],
+                        help="Write a set of FITS files per beam (and antenna), one consolidated cube store \n" +
+                             "for the date (see modules/cube_store.py), or both. \n(default: '%(default)s').")
+    parser.add_argument('--qc', action='store_true',
+                        help="Screen the data first and only grid the tasks and antennas that pass, with a \n" +
+                             "report of the problems in a csv file (see modules/drift_qc.py).")
+    parser.add_argument('--dtype', default='float64', choices=sorted(dtypes),
+                        help="Data type of the FITS files. \n(default: '%(default)s').")
+    parser.add_argument('--compress', action='store_true',
+                        help="Write lossless tile compressed FITS files.")
+
+    args = parser.parse_args()
+    if setup is not None:
+        args.setup = setup
+    if maps is not None:
+        args.maps = maps
+    return args
+
+
+def write_report(path, report):
+    """
+    Write the residuals of the gridding backend against the cubic backend, and print a summary.
+    """
+    report = pd.DataFrame(report, columns=['beam', 'antenna', 'pol', 'rms', 'max_abs', 'lobe_rms', 'lobe_max_abs',
+                                           'missing', 'time', 'time_cubic'])
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    report.to_csv(path, index=False)
+
+    # The times are per beam, shared by all antennas and polarisations of the beam
+    times = report.drop_duplicates('beam')
+    print("Residuals against the cubic gridding (normalised maps): median rms {:.2e}, median rms in the main lobe "
+          "{:.2e}, max {:.2e}".format(report['rms'].median(), report['lobe_rms'].median(), report['max_abs'].max()))
+    print("Gridding time {:.1f} s, cubic {:.1f} s".format(times['time'].sum(), times['time_cubic'].sum()))
+    print("Report written to {}".format(path))
+
+
+def write_missing(path, missing):
+    """
+    Write the beams and antennas without data (no maps were made for them), and print a summary.
+    """
+    missing = pd.DataFrame(missing, columns=['beam', 'antenna'])
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    missing.to_csv(path, index=False)
+    print("{} beam maps left out for lack of data, listed in {}".format(len(missing), path))
+
+
+def main(setup=None, maps=None):
+
+    start = time.time()
+    args = parse_args(setup, maps)
+
+    print(args.beams)
+    beam_range = args.beams.split(',')
+    beams = range(int(beam_range[0]), int(beam_range[1])+1)
+    setup = get_setup(args.setup)
+    freqchunks = args.bin_num if args.bin_num is not None else setup.bin_num
+    date = args.date
+
+    print(beams)
+
+    basedir = args.basedir
+
+    with open(args.task_ids) as f:
+        task_id = f.read().splitlines()
+
+    # NaN samples and empty cells in the maps are expected, e.g. the medians of missing data
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+
+    # Find calibrator position in the offline catalogue
+    calib = get_calibrator(args.calibname, resolve=args.resolve)
+
+    cell_size = 100. / 3600.
+
+    # Put all the output from drift_scan_auto_corr.ipynb in a unique folder per source, per set of drift scans.
+    tasks = sorted(task_id)
+
+    # Put calibrator into apparent coordinates (because that is what the telescope observes it in.)
+    calibnow = apparent_coordinates(args.calibname, task_id[0], resolve=args.resolve)
+
+    # Read data from the binary stores (or the csv tables of older extractions)
+    data_tab, hadec_tab = [], []
+    print("\nReading in all the data...")
+    for tid in tasks:
+        data, hadec = read_drift_data(basedir, tid)
+        data_tab.append(data)  # list of tables
+        hadec_tab.append(hadec)  # list of tables
+
+    # Offsets of the samples of all beams from the calibrator, computed (or read from the cache) once per task
+    print("Calculating coordinates...")
+    offsets = [task_offsets(basedir, tid, data, hadec, calibnow) for tid, data, hadec in zip(tasks, data_tab, hadec_tab)]
+
+    # The compound beam (None) and the antennas of a beam are made in the same job
+    antennas = []
+    if args.maps in ['compound', 'both']:
+        antennas.append(None)
+    if args.maps in ['antennas', 'both']:
+        antennas.extend(range(12))
+
+    cdelt, crval = spectral_axis(setup)
+    wcs_meta = {'cell_size': cell_size, 'cdelt': cdelt, 'crval': crval, 'ra': calib.ra.to_value(u.deg),
+                'dec': calib.dec.to_value(u.deg)}
+    outdir = os.path.join(basedir, 'fits_files', date)
+
+    # The tasks, antennas and the tasks left out per antenna to grid for every beam, all of them without the
+    # quality screen
+    plan = dict((beam, (None, antennas, {})) for beam in beams)
+    if args.qc:
+        print("Screening the data...")
+        plan, qc_report = screen_drifts(data_tab, offsets, tasks, beams, antennas, freqchunks, calibnow.dec.deg,
+                                        cell_size)
+        write_qc_report(os.path.join(outdir, '{}_{}_qc.csv'.format(args.calibname.replace(" ", ""), date)),
+                        qc_report, plan, beams, antennas)
+        beams = [beam for beam in beams if beam in plan]
+
+    store = None
+    if args.output_format in ['cube', 'both']:
+        # The size of the maps of every beam is known before gridding, so the store is allocated at once
+        shapes = dict((beam, beam_geometry(select_tasks(offsets, plan[beam][0]), beam, calibnow.dec.deg, cell_size,
+                                           args.crop)[-1]) for beam in beams)
+        store = CubeStoreWriter(cube_store_path(basedir, date, args.calibname), beams, antennas, freqchunks, shapes,
+                                wcs_meta, calibname=args.calibname, date=date, setup=setup.name, tasks=tasks,
+                                gridder=args.gridder, crop=args.crop)
+
+    print("Making beam maps ({} frequency setup, {} gridding): ".format(setup.name, args.gridder))
+    jobs = [(beam, plan[beam][1], plan[beam][0], plan[beam][2]) for beam in beams]
+    results = map_jobs(beam_cubes, jobs, workers=args.workers, initializer=init_worker,
+                       initargs=(data_tab, offsets, calibnow.dec.deg, cell_size, freqchunks, args.crop,
+                                 args.gridder, args.report))
+    missing = []
+    report = []
+    for beam, cubes, beam_report in results:
+        print(beam)
+        report.extend(beam_report)
+        for ant, ant_cubes in cubes:
+            # Only the map of this beam and antenna is left out, the antenna can have data for the other beams
+            if ant_cubes is None:
+                print('There is no data for beam {} antenna: {}'.format(beam, 'CB' if ant is None else ant))
+                missing.append((beam, 'CB' if ant is None else ant))
+                continue
+            cube_xx, cube_yy, ref_pixx, ref_pixy = ant_cubes
+
+            if store is not None:
+                store.add(beam, ant, cube_xx, cube_yy, ref_pixx, ref_pixy)
+            if args.output_format in ['fits', 'both']:
+                write_fits_cubes(fits_path(basedir, date, args.calibname, beam, ant), cube_xx, cube_yy,
+                                 beam_header(wcs_meta, ref_pixx, ref_pixy), dtype=args.dtype, compress=args.compress)
+
+    if store is not None:
+        store.close()
+        print("Cubes written to {}".format(store.path))
+    if missing:
+        write_missing(os.path.join(outdir, '{}_{}_missing.csv'.format(args.calibname.replace(" ", ""), date)),
+                      missing)
+    if report:
+        write_report(os.path.join(outdir, '{}_{}_gridding_{}.csv'.format(args.calibname.replace(" ", ""), date,
+                                                                          args.gridder)), report)
+
+    end = time.time()
+    print('Time [minutes]: ', (end - start)/60)
+
+
+if __name__ == '__main__':
+    main()